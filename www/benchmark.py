@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Micro benchmarks of transwarp.db and transwarp.orm hot paths and of the
+transwarp.web router
+
+Usage:
+    python benchmark.py --scale 10000 --output base.json
+    python benchmark.py --scale 10000 --compare base.json --threshold 0.2
+    python benchmark.py --suite router --routes 5000
+
+Every sample repeats a benchmark until it lasts at least --min-time
+seconds. With --compare the best samples are compared and the exit status
+is 1 if any benchmark got slower than the baseline by more than threshold
+"""
+import os,sys,gc,time,json,random,shutil,tempfile,argparse,platform,sqlite3
+from transwarp import db,web
+from models import User,Blog,Comment,generate_tables
+
+def generate_data(scale,seed=0):
+    """
+    Insert scale comments, scale/10 blogs and scale/100 users, return the
+    lists of user and blog ids
+    """
+    rnd = random.Random(seed)
+    users = [User(id=db.get_id(),email='user%d@example.com' % i,password='x' * 32,
+                  admin=False,name='user%d' % i) for i in range(max(scale / 100,1))]
+    User.insert_many(users)
+    blogs = []
+    for i in range(max(scale / 10,1)):
+        u = rnd.choice(users)
+        blogs.append(Blog(id=db.get_id(),user_id=u.id,user_name=u.name,name='blog %d' % i,
+                          summary='summary ' * 10,content='content ' * 200))
+    Blog.insert_many(blogs)
+    comments = []
+    for i in range(scale):
+        u = rnd.choice(users)
+        comments.append(Comment(id=db.get_id(),blog_id=rnd.choice(blogs).id,user_id=u.id,
+                                user_name=u.name,content='comment ' * 20))
+    Comment.insert_many(comments)
+    return [u.id for u in users],[b.id for b in blogs]
+
+class _Rollback(Exception):
+    pass
+
+def _rolled_back(f):
+    """
+    Run a write benchmark in a transaction rolled back afterwards, so every
+    run and the benchmarks after it see the same data
+    """
+    def _wrapper(self):
+        result = []
+        try:
+            with db.transaction():
+                result.append(f(self))
+                raise _Rollback()
+        except _Rollback:
+            pass
+        return result[0]
+    return _wrapper
+
+class Suite(object):
+    """
+    Every bench_ method runs one measured operation and returns the number
+    of elementary operations it performed
+    """
+    def names(self):
+        return sorted([k[6:] for k in dir(self) if k.startswith('bench_')])
+
+    def run(self,name,repeat,min_time=0.1):
+        f = getattr(self,'bench_%s' % name)
+        #calibrate the number of calls of a sample, short ones are mostly noise
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        loops = elapsed < min_time and int(min_time / max(elapsed,1e-6)) + 1 or 1
+        times = []
+        #like timeit, collections triggered by earlier benchmarks are noise
+        gc.disable()
+        try:
+            for i in range(repeat):
+                start = time.time()
+                for j in xrange(loops):
+                    ops = f()
+                times.append((time.time() - start) / loops)
+        finally:
+            gc.enable()
+        times.sort()
+        median = times[len(times) / 2]
+        return dict(best=times[0],median=median,ops=ops,loops=loops,
+                    ops_per_sec=median and ops / median or 0.0)
+
+class Benchmarks(Suite):
+    """
+    Database and model operations
+    """
+    def __init__(self,scale,user_ids,blog_ids,seed=0):
+        self.scale = scale
+        self.user_ids = user_ids
+        self.blog_ids = blog_ids
+        self.rnd = random.Random(seed)
+        rows = db.select_all('select * from `%s`' % Blog.__table__)
+        self.blog_rows = rows
+
+    def bench_get(self):
+        n = min(self.scale,1000)
+        for i in xrange(n):
+            Blog.get(self.rnd.choice(self.blog_ids))
+        return n
+
+    def bench_get_many(self):
+        ids = self.rnd.sample(self.blog_ids,min(len(self.blog_ids),500))
+        Blog.get_many(ids)
+        return len(ids)
+
+    @_rolled_back
+    def bench_insert(self):
+        n = min(self.scale / 10 or 1,500)
+        with db.transaction():
+            for i in xrange(n):
+                Comment(id=db.get_id(),blog_id=self.blog_ids[0],user_id=self.user_ids[0],
+                        content='insert').insert()
+        return n
+
+    @_rolled_back
+    def bench_insert_many(self):
+        n = min(self.scale,5000)
+        Comment.insert_many([Comment(id=db.get_id(),blog_id=self.blog_ids[0],
+                                     user_id=self.user_ids[0],content='bulk')
+                             for i in xrange(n)])
+        return n
+
+    def bench_find_by(self):
+        return len(Comment.find_by('where user_id<>?',''))
+
+    def bench_select_all(self):
+        return len(db.select_all('select * from `%s`' % Comment.__table__))
+
+    def bench_iter_all(self):
+        n = 0
+        for c in Comment.iter_all(batch_size=500):
+            n = n + 1
+        return n
+
+    @_rolled_back
+    def bench_update(self):
+        blogs = Blog.get_many(self.rnd.sample(self.blog_ids,min(len(self.blog_ids),200))).values()
+        with db.transaction():
+            for b in blogs:
+                b.name = 'renamed %f' % self.rnd.random()
+                b.update()
+        return len(blogs)
+
+    def bench_count(self):
+        for i in xrange(100):
+            Comment.count_by('where blog_id=?',self.rnd.choice(self.blog_ids))
+        Comment.count_all()
+        return 101
+
+    def bench_hydration(self):
+        for d in self.blog_rows:
+            Blog._from_row(d)
+        return len(self.blog_rows)
+
+    def bench_construct(self):
+        for d in self.blog_rows:
+            Blog(**d)
+        return len(self.blog_rows)
+
+class RouterBenchmarks(Suite):
+    """
+    Dispatch over a router of n static and n dynamic routes, compared with
+    scanning the routes one by one
+    """
+    def __init__(self,n,seed=0):
+        self.rnd = random.Random(seed)
+        self.router = web.Router()
+        self.routes = []
+        for i in range(n):
+            for path in ('/section%d/page' % i,'/section%d/:id/item/:item' % i):
+                self.routes.append(web.Route(_handler('GET',path)))
+                self.router.add(self.routes[-1])
+        self.static_paths = ['/section%d/page' % self.rnd.randrange(n) for i in range(1000)]
+        self.dynamic_paths = ['/section%d/%d/item/%d' % (self.rnd.randrange(n),i,i) for i in range(1000)]
+
+    def bench_router_static(self):
+        for path in self.static_paths:
+            self.router.match('GET',path)
+        return len(self.static_paths)
+
+    def bench_router_dynamic(self):
+        for path in self.dynamic_paths:
+            self.router.match('GET',path)
+        return len(self.dynamic_paths)
+
+    def bench_router_linear(self):
+        paths = self.dynamic_paths[:50]
+        for path in paths:
+            for route in self.routes:
+                if route.is_static:
+                    if route.path == path:
+                        break
+                elif route.match(path) is not None:
+                    break
+        return len(paths)
+
+def _handler(method,path):
+    f = lambda *args: None
+    f.__web_route__ = path
+    f.__web_method__ = method
+    return f
+
+def compare(results,baseline,threshold):
+    """
+    Print the ratio of the best times to the baseline of every benchmark,
+    return the names of the ones slower by more than threshold
+    """
+    regressions = []
+    for name in sorted(results):
+        if not name in baseline:
+            continue
+        base = baseline[name]['best']
+        ratio = base and results[name]['best'] / base or 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print '%-16s %10.2f ms  baseline %10.2f ms  x%.2f%s' % \
+              (name,results[name]['best'] * 1000,base * 1000,ratio,flag)
+    return regressions
+
+def run_suite(benchmarks,args,results):
+    for name in benchmarks.names():
+        if args.only and not name in args.only:
+            continue
+        results[name] = benchmarks.run(name,args.repeat,args.min_time)
+        print '%-16s %10.2f ms %12.0f ops/s' % (name,results[name]['median'] * 1000,
+                                                results[name]['ops_per_sec'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='transwarp micro benchmarks')
+    parser.add_argument('--suite',action='append',choices=['db','router'],
+                        help='benchmark suite to run, may be repeated, default all')
+    parser.add_argument('--scale',type=int,default=10000,help='number of comments to generate')
+    parser.add_argument('--routes',type=int,default=2000,
+                        help='number of static and of dynamic routes of the router suite')
+    parser.add_argument('--repeat',type=int,default=7,help='samples of each benchmark')
+    parser.add_argument('--min-time',type=float,default=0.1,
+                        help='minimum seconds of a sample, short benchmarks are repeated')
+    parser.add_argument('--only',action='append',help='run only this benchmark, may be repeated')
+    parser.add_argument('--output',help='write results as JSON to this file')
+    parser.add_argument('--compare',help='baseline JSON file to compare with')
+    parser.add_argument('--threshold',type=float,default=0.2,
+                        help='allowed slowdown ratio against the baseline')
+    args = parser.parse_args(argv)
+
+    suites = args.suite or ['db','router']
+    results = {}
+    if 'db' in suites:
+        tmp = tempfile.mkdtemp(prefix='transwarp-bench-')
+        try:
+            db.create_engine(os.path.join(tmp,'bench.db'))
+            generate_tables()
+            start = time.time()
+            user_ids,blog_ids = generate_data(args.scale)
+            print 'generated data for scale %d in %.2f s' % (args.scale,time.time() - start)
+            run_suite(Benchmarks(args.scale,user_ids,blog_ids),args,results)
+            db.engine.pool.dispose()
+        finally:
+            shutil.rmtree(tmp)
+    if 'router' in suites:
+        run_suite(RouterBenchmarks(args.routes),args,results)
+
+    report = dict(meta=dict(scale=args.scale,routes=args.routes,repeat=args.repeat,
+                            min_time=args.min_time,time=time.time(),
+                            python=platform.python_version(),sqlite=sqlite3.sqlite_version,
+                            machine=platform.machine()),
+                  results=results)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=2,sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta']['scale'] != args.scale:
+            print 'warning: baseline scale is %s' % baseline['meta']['scale']
+        regressions = compare(results,baseline['results'],args.threshold)
+        if regressions:
+            print 'regressions: %s' % ', '.join(regressions)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,45 +3,55 @@
 import time,uuid
 from transwarp.db import get_id
 from transwarp import db
-from transwarp.orm import Model,StringField,BooleanField,FloatField,TextField
+from transwarp.orm import Model,StringField,BooleanField,FloatField,TextField,BelongsTo,HasMany
 
 class  User(Model):
     __table__ = 'users'
     id = StringField(primary_key=True,default = get_id,updatable=False)
-    email = StringField(updatable=False)
+    email = StringField(updatable=False,unique=True)
     password = StringField()
     admin = BooleanField()
     name =  StringField()
     created_at = FloatField(updatable=False,default = time.time)
 
+    blogs = HasMany('Blog','user_id','order by created_at desc')
+
 
 class Blog(Model):
     __table__ = 'blogs'
     id = StringField(primary_key=True,default = get_id,updatable=False)
-    user_id = StringField(updatable=False)
+    user_id = StringField(updatable=False,index=True)
     user_name = StringField()
     name = StringField()
     summary = StringField()
     content = TextField()
-    created_at = FloatField(updatable=False,default = time.time)
+    created_at = FloatField(updatable=False,default = time.time,index=True)
+
+    user = BelongsTo('User','user_id')
+    comments = HasMany('Comment','blog_id','order by created_at')
 
 class Comment(Model):
     __talbe__ = 'comments'
+    __indexes__ = (('blog_id','created_at'),)
     id = StringField(primary_key = True,default = get_id,updatable=False)
     blog_id = StringField(updatable=False)
-    user_id = StringField(updatable=False)
+    user_id = StringField(updatable=False,index=True)
     user_name = StringField()
     content = TextField()   
     created_at = FloatField(updatable=False,default = time.time)
 
+    blog = BelongsTo('Blog','blog_id')
+    user = BelongsTo('User','user_id')
+
 def generate_tables():
     if not db.engine:
         db.create_engine('awesome.db')
     
     sql = lambda x:''.join(x().__sql__.split('\n')[1:])   
-    db.update(sql(User))
-    db.update(sql(Blog))
-    db.update(sql(Comment))
+    for m in (User,Blog,Comment):
+        db.update(sql(m))
+        for index_sql in m.__index_sql__:
+            db.update(index_sql)
 
 if __name__ == '__main__':
     generate_tables()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #-*- coding:utf-8 -*-
-import time,uuid,functools,threading
+import time,uuid,functools,threading,collections,re,sys,Queue,logging
 
 #Dict object
 class Dict(dict):
@@ -9,9 +9,7 @@ class Dict(dict):
 
     """
     def __init__(self,names=(),values=(),**kw):
-        super(Dict,self).__init__(**kw)
-        for k,v in zip(names,values):
-            self[k] = v
+        super(Dict,self).__init__(zip(names,values),**kw)
             
     def __getattr__(self,key):
         try:
@@ -22,6 +20,72 @@ class Dict(dict):
     def __setattr__(self,key,value):
         self[key] = value
 
+_tuple_getitem = tuple.__getitem__
+
+class Row(tuple):
+    """
+    Compact read only row backed by a tuple. One subclass is built per distinct
+    column list, so a row costs no more than a tuple but still allows access
+    like x.y and x['y']
+
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self,key):
+        if isinstance(key,basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+        return _tuple_getitem(self,key)
+
+    def __getattr__(self,key):
+        raise AttributeError(r'Row object has no attribute %s' % key)
+
+    def __contains__(self,key):
+        return key in self._index
+
+    def get(self,key,default=None):
+        i = self._index.get(key)
+        return default if i is None else _tuple_getitem(self,i)
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return zip(self._fields,self)
+
+    def to_dict(self):
+        return Dict(self._fields,self)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join(['%s=%r' % kv for kv in zip(self._fields,self)])
+
+#cache of Row subclasses keyed by column names
+_row_classes = {}
+
+def _row_class(names):
+    """
+    Return the cached Row subclass for the column names
+
+    """
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        index = {}
+        attrs = {'__slots__':(),'_fields':names,'_index':index}
+        for i,name in enumerate(names):
+            index[name] = i
+            attrs[name] = property(lambda self,i=i: _tuple_getitem(self,i))
+        cls = type('Row',(Row,),attrs)
+        _row_classes[names] = cls
+    return cls
+
+def _dict_row(names):
+    return lambda values: Dict(names,values)
+
 def get_id(t=None):
     """
     Return unique id which is combination of uuid and timestamp, default timestamp
@@ -45,33 +109,121 @@ class _LazyConnection(object):
     """
     def __init__(self):
         self.connection = None
+        self.read_connection = None
+        #number of select_iter generators reading from the connections
+        self.pins = 0
+        self.closed = False
 
-    def cursor(self):
+    def cursor(self,read=False):
+        """
+        Return a cursor, of a read only connection if read is set and the
+        engine has a read pool
+
+        """
+        if read and engine.read_pool is not None:
+            if self.read_connection is None:
+                self.read_connection = engine.connect(read=True)
+            return self.read_connection.cursor()
         if self.connection is None:
             self.connection = engine.connect()
         return self.connection.cursor()
 
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
+
+    def release_writer(self):
+        """
+        Return the single writer of a wal engine to its pool between
+        transactions, so one connection context does not block the writes of
+        other threads until it ends
+        """
+        if self.connection and not self.pins and engine.read_pool is not None:
+            engine.release(self.connection)
+            self.connection = None
+
+    def pin(self):
+        self.pins = self.pins + 1
+
+    def unpin(self):
+        self.pins = self.pins - 1
+        if self.pins == 0 and self.closed:
+            self.cleanup()
 
     def cleanup(self):
+        #release the connections once the last generator reading them stops
+        if self.pins:
+            self.closed = True
+            return
         if self.connection:
-            self.connection.close()
+            engine.release(self.connection)
             self.connection = None
+        if self.read_connection:
+            engine.release(self.read_connection,read=True)
+            self.read_connection = None
+
+class _IdentityMap(object):
+    """
+    Map of objects already loaded in a connection context, keyed by
+    (table,primary key)
+
+    """
+    def __init__(self):
+        self._objects = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key):
+        obj = self._objects.get(key)
+        if obj is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+        return obj
+
+    def merge(self,key,obj):
+        """
+        Register obj unless key is already mapped, return the mapped object
+
+        """
+        return self._objects.setdefault(key,obj)
+
+    def add(self,key,obj):
+        self._objects[key] = obj
+
+    def remove(self,key):
+        self._objects.pop(key,None)
+
+    def clear(self):
+        self._objects.clear()
+
+    def evict(self,table):
+        """
+        Remove the objects of table
+
+        """
+        for key in [k for k in self._objects if k[0] == table]:
+            del self._objects[key]
+
+    def stats(self):
+        return Dict(hits=self.hits,misses=self.misses,size=len(self._objects))
 
 class _DbCtx(threading.local):
     """
    
-    Thread local object that holds _Lazyconnection object and the counter of
-    transactions
+    Thread local object that holds _Lazyconnection object, the counter of
+    transactions and the optional identity map
 
     """
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.identity_map = None
+        self.written = []
     
     def is_init(self):
         return not self.connection is None
@@ -79,10 +231,13 @@ class _DbCtx(threading.local):
     def init(self):
         self.connection = _LazyConnection()
         self.transactions = 0
+        self.identity_map = None
+        self.written = []
 
     def cleanup(self):
         self.connection.cleanup()
         self.connection = None
+        self.identity_map = None
 
     def cursor(self):
         return self.connection.cursor()
@@ -92,20 +247,677 @@ _db_ctx = _DbCtx()
 
 #global object engine
 engine = None
-class _Engine(object):
-    def __init__(self,connect):
+
+class _ConnectionPool(object):
+    """
+    Bounded, thread safe pool of connections created by the connect function
+
+    Usage:
+        pool = _ConnectionPool(connect,min_size=1,max_size=5)
+        conn = pool.acquire()
+        pool.release(conn)
+
+    """
+    def __init__(self,connect,min_size=0,max_size=10,timeout=30.0,max_idle=None,pre_ping=False):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise DBError('Invalid pool size: min_size=%s max_size=%s' % (min_size,max_size))
         self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.pre_ping = pre_ping
+        #idle connections are stored as (connection,returned_at) pairs
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._cond = threading.Condition(threading.Lock())
+        for i in range(min_size):
+            self._idle.append((self._connect(),time.time()))
+            self._size = self._size + 1
 
-    def connect(self):
-        return self._connect()
+    def _alive(self,conn):
+        try:
+            conn.execute('select 1')
+            return True
+        except Exception:
+            return False
 
-def create_engine(database):
+    def _discard(self,conn):
+        self._size = self._size - 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _take_idle(self):
+        """
+        Return an idle connection or None, dropping expired ones on the way.
+        Must be called with the lock held
+
+        """
+        if self.max_idle is not None:
+            #oldest connections are at the left end of the deque
+            expired = time.time() - self.max_idle
+            while self._idle and self._idle[0][1] < expired and self._size > self.min_size:
+                self._discard(self._idle.popleft()[0])
+        if self._idle:
+            return self._idle.pop()[0]
+        return None
+
+    def acquire(self):
+        """
+        Borrow a connection, waiting up to timeout seconds when the pool is exhausted
+
+        """
+        with self._cond:
+            conn = self._take_idle()
+            if conn is None and self._size >= self.max_size:
+                self._waits = self._waits + 1
+                start = time.time()
+                deadline = start + self.timeout
+                while conn is None and self._size >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._wait_time = self._wait_time + time.time() - start
+                        raise DBError('Timeout waiting for connection after %s seconds' % self.timeout)
+                    self._cond.wait(remaining)
+                    conn = self._take_idle()
+                self._wait_time = self._wait_time + time.time() - start
+            if conn is None:
+                self._size = self._size + 1
+            self._in_use = self._in_use + 1
+        if conn is not None and self.pre_ping and not self._alive(conn):
+            with self._cond:
+                self._discard(conn)
+                self._size = self._size + 1
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except:
+                with self._cond:
+                    self._size = self._size - 1
+                    self._in_use = self._in_use - 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self,conn):
+        """
+        Return a connection to the pool, uncommitted work is rolled back
+
+        """
+        try:
+            conn.rollback()
+            broken = False
+        except Exception:
+            broken = True
+        with self._cond:
+            self._in_use = self._in_use - 1
+            if broken:
+                self._discard(conn)
+            else:
+                self._idle.append((conn,time.time()))
+            self._cond.notify()
+
+    def dispose(self):
+        """
+        Close all idle connections
+
+        """
+        with self._cond:
+            while self._idle:
+                conn,returned_at = self._idle.pop()
+                self._discard(conn)
+
+    def stats(self):
+        """
+        Return pool statistics as a Dict
+
+        """
+        with self._cond:
+            return Dict(size=self._size,in_use=self._in_use,idle=len(self._idle),
+                        max_size=self.max_size,waits=self._waits,wait_time=self._wait_time)
+
+class _Engine(object):
+    """
+    Holds the connection pools. With read_connect selects outside transactions
+    use a pool of read connections and everything else a single writer
+
+    """
+    def __init__(self,connect,compact_rows=False,read_connect=None,**pool_kw):
+        #row_factory takes the column names and returns a function building a row
+        self.row_factory = compact_rows and _row_class or _dict_row
+        self.query_cache = None
+        self.group_commit = None
+        if read_connect is None:
+            self.read_pool = None
+            self.pool = _ConnectionPool(connect,**pool_kw)
+        else:
+            self.read_pool = _ConnectionPool(read_connect,**pool_kw)
+            pool_kw.update(min_size=0,max_size=1)
+            self.pool = _ConnectionPool(connect,**pool_kw)
+
+    def connect(self,read=False):
+        if read and self.read_pool is not None:
+            return self.read_pool.acquire()
+        return self.pool.acquire()
+
+    def release(self,conn,read=False):
+        if read and self.read_pool is not None:
+            self.read_pool.release(conn)
+        else:
+            self.pool.release(conn)
+
+#pragmas of connections in wal mode
+_WAL_PRAGMAS = {
+    'synchronous':'NORMAL',
+    'cache_size':-16000,
+    'mmap_size':256 * 1024 * 1024,
+    'busy_timeout':5000,
+}
+
+def _wal_connect(database,pragmas,read):
+    import sqlite3
+    conn = sqlite3.connect(database,check_same_thread=False)
+    for k,v in pragmas.iteritems():
+        conn.execute('pragma %s=%s' % (k,v))
+    if read:
+        conn.execute('pragma query_only=1')
+    return conn
+
+def create_engine(database,min_size=0,max_size=10,timeout=30.0,max_idle=None,pre_ping=False,
+                  compact_rows=False,wal=False,pragmas=None):
+    """
+    Initialize the global engine, connections are borrowed from a pool of at most
+    max_size connections. timeout is the maximum seconds to wait for a free connection,
+    idle connections older than max_idle seconds are closed, and pre_ping checks a
+    connection with 'select 1' before handing it out. With compact_rows selects
+    return read only Row objects instead of Dict
+
+    With wal the database is opened in WAL mode with the pragmas of _WAL_PRAGMAS
+    updated by pragmas. Selects outside transactions go to a pool of max_size
+    read only connections, writes and transactions to a single writer
+
+    """
     import sqlite3
     global engine
     if engine is not None:
         raise DBError('Engine is already initialized')
 
-    engine = _Engine(lambda : sqlite3.connect(database))
+    pool_kw = dict(min_size=min_size,max_size=max_size,timeout=timeout,
+                   max_idle=max_idle,pre_ping=pre_ping,compact_rows=compact_rows)
+    if wal:
+        all_pragmas = dict(_WAL_PRAGMAS)
+        all_pragmas.update(pragmas or {})
+        #the journal mode is stored in the database, set it before readers open it
+        conn = sqlite3.connect(database)
+        try:
+            conn.execute('pragma journal_mode=WAL')
+        finally:
+            conn.close()
+        engine = _Engine(lambda : _wal_connect(database,all_pragmas,False),
+                         read_connect=lambda : _wal_connect(database,all_pragmas,True),
+                         **pool_kw)
+        return
+    #pooled connections are handed to different threads, one thread at a time
+    engine = _Engine(lambda : sqlite3.connect(database,check_same_thread=False),**pool_kw)
+
+def pool_stats(read=False):
+    """
+    Return statistics of the engine connection pool, of the read pool if read
+    is set
+
+    """
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    if read:
+        if engine.read_pool is None:
+            raise DBError('Engine has no read pool')
+        return engine.read_pool.stats()
+    return engine.pool.stats()
+
+#words of a statement, any of them may be a table the result depends on
+_RE_WORDS = re.compile(r'\w+')
+
+#tables changed by insert, replace, update and delete statements
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:(?:insert|replace)(?:\s+or\s+\w+)?\s+into|update(?:\s+or\s+\w+)?|delete\s+from)\s+[`"\[]?(\w+)',re.I)
+
+def _write_tables(sql):
+    """
+    Return the tuple of tables a write statement changes or None if unknown
+
+    """
+    m = _RE_WRITE_TABLE.match(sql)
+    return (m.group(1).lower(),) if m else None
+
+def _estimate_size(value):
+    if value is None:
+        return 0
+    rows = isinstance(value,list) and value or [value]
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size = size + sys.getsizeof(row)
+        for v in row.values() if isinstance(row,dict) else row:
+            size = size + sys.getsizeof(v)
+    return size
+
+class LRUCache(object):
+    """
+    Values bounded by their number and total size, the least recently used
+    are evicted first. Not thread safe, callers sharing it hold a lock
+
+    Usage:
+        cache = LRUCache(max_entries=100,max_bytes=1024 * 1024)
+        cache.put('key',value,len(value))
+        cache.get('key')
+
+    """
+    def __init__(self,max_entries=None,max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self,key):
+        entry = self._entries.pop(key,None)
+        if entry is None:
+            return None
+        self._entries[key] = entry
+        return entry[0]
+
+    def pop(self,key):
+        entry = self._entries.pop(key,None)
+        if entry is None:
+            return None
+        self.bytes = self.bytes - entry[1]
+        return entry[0]
+
+    def put(self,key,value,size):
+        self.pop(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self._entries[key] = (value,size)
+        self.bytes = self.bytes + size
+        while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes):
+            k,(v,n) = self._entries.popitem(last=False)
+            self.bytes = self.bytes - n
+            self.evictions = self.evictions + 1
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+class TableVersions(object):
+    """
+    Version counters of tables. A cache entry records the snapshot of the
+    tables it was built from and is stale once the snapshot changes. Not
+    thread safe, callers sharing it hold a lock
+
+    """
+    def __init__(self):
+        self._versions = {}
+        self._epoch = 0
+
+    def snapshot(self,tables):
+        versions = self._versions
+        return (self._epoch,tuple([versions.get(t,0) for t in tables]))
+
+    def bump(self,tables=None):
+        """
+        Bump the versions of tables, or of everything if tables is None
+
+        """
+        if tables is None:
+            self._epoch = self._epoch + 1
+            return
+        for t in tables:
+            self._versions[t] = self._versions.get(t,0) + 1
+
+class _QueryCache(object):
+    """
+    LRU cache of select results with ttl and size limits. Every entry records
+    the versions of the tables it may depend on, writes bump the versions so
+    stale entries are dropped when they are read
+
+    """
+    def __init__(self,max_entries=1000,ttl=60.0,max_bytes=16 * 1024 * 1024):
+        self.ttl = ttl
+        self._entries = LRUCache(max_entries,max_bytes)
+        self._versions = TableVersions()
+        self._words = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def tables(self,sql):
+        words = self._words.get(sql)
+        if words is None:
+            if len(self._words) > 4096:
+                self._words.clear()
+            words = self._words[sql] = tuple(set([w.lower() for w in _RE_WORDS.findall(sql)]))
+        return words
+
+    def snapshot(self,tables):
+        return self._versions.snapshot(tables)
+
+    def get(self,key,tables):
+        """
+        Return (True,value) on hit or (False,None)
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value,snapshot,expires = entry
+                if expires < time.time():
+                    self.expirations = self.expirations + 1
+                elif snapshot != self.snapshot(tables):
+                    self.invalidations = self.invalidations + 1
+                else:
+                    self.hits = self.hits + 1
+                    return True,value
+                self._entries.pop(key)
+            self.misses = self.misses + 1
+            return False,None
+
+    def put(self,key,tables,snapshot,value):
+        size = _estimate_size(value)
+        with self._lock:
+            #a write happened while the query was running
+            if snapshot != self.snapshot(tables):
+                return
+            self._entries.put(key,(value,snapshot,time.time() + self.ttl),size)
+
+    def invalidate(self,tables=None):
+        """
+        Bump the versions of tables, or drop everything if tables is None
+
+        """
+        with self._lock:
+            self._versions.bump(tables)
+            if tables is None:
+                self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return Dict(hits=self.hits,misses=self.misses,
+                        hit_ratio=total and float(self.hits) / total or 0.0,
+                        evictions=self._entries.evictions,expirations=self.expirations,
+                        invalidations=self.invalidations,entries=len(self._entries),
+                        bytes=self._entries.bytes)
+
+def enable_query_cache(max_entries=1000,ttl=60.0,max_bytes=16 * 1024 * 1024):
+    """
+    Cache results of select_one and select_all outside transactions. Rows are
+    shared between callers and must not be modified
+
+    """
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    engine.query_cache = _QueryCache(max_entries,ttl,max_bytes)
+
+def disable_query_cache():
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    engine.query_cache = None
+
+def query_cache_stats():
+    """
+    Return statistics of the query cache or None if it is disabled
+
+    """
+    if engine is None or engine.query_cache is None:
+        return None
+    return engine.query_cache.stats()
+
+class _Histogram(object):
+    """
+    Counts of values falling under each upper bound, the last bucket is
+    unbounded
+
+    """
+    def __init__(self,bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self,value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i = i + 1
+        self.counts[i] = self.counts[i] + 1
+        self.total = self.total + 1
+        self.sum = self.sum + value
+
+    def to_dict(self):
+        labels = ['<=%s' % b for b in self.bounds] + ['>%s' % self.bounds[-1]]
+        return Dict(buckets=zip(labels,self.counts),count=self.total,
+                    mean=self.total and self.sum / self.total or 0.0)
+
+class _WriteRequest(object):
+    def __init__(self,sql,args):
+        self.sql = sql
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class _GroupCommitter(object):
+    """
+    Single writer thread running autocommit statements on a connection of
+    pool. Statements arriving within window seconds, up to max_batch of
+    them, share one transaction and one commit. Every statement runs in its
+    own savepoint so a failing one does not affect the others
+
+    """
+    def __init__(self,pool,window=0.002,max_batch=64):
+        self.window = window
+        self.max_batch = max_batch
+        self._pool = pool
+        #set when the writer thread died, later statements fail with it
+        self.error = None
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self.commit_latency = _Histogram([0.5,1,2,5,10,20,50,100,200,500,1000])
+        self.batch_size = _Histogram([1,2,4,8,16,32,64,128,256])
+        self._thread = threading.Thread(target=self._run,name='transwarp-group-commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def execute(self,sql,args):
+        """
+        Queue a statement and wait for its rowcount
+
+        """
+        if self.error is not None:
+            raise self.error
+        req = _WriteRequest(sql,args)
+        self._queue.put(req)
+        while not req.done.wait(0.1):
+            if self.error is not None:
+                raise self.error
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self,first):
+        batch = [first]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    req = self._queue.get(True,remaining)
+                else:
+                    req = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if req is None:
+                #keep the stop request for the main loop
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                req = self._queue.get()
+                if req is None:
+                    return
+                self._write(self._collect(req))
+        except Exception, e:
+            logging.exception('Group commit writer failed')
+            self.error = DBError('Group commit writer failed: %s' % e)
+            while True:
+                try:
+                    req = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if req is not None:
+                    req.error = self.error
+                    req.done.set()
+
+    def _write(self,batch):
+        start = time.time()
+        conn = None
+        cursor = None
+        try:
+            conn = self._pool.acquire()
+            #transactions are managed explicitly with begin, savepoint and commit
+            level = conn.isolation_level
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute('begin')
+            for req in batch:
+                cursor.execute('savepoint stmt')
+                try:
+                    cursor.execute(req.sql,req.args)
+                    req.result = cursor.rowcount
+                    cursor.execute('release stmt')
+                except Exception, e:
+                    req.error = e
+                    cursor.execute('rollback to stmt')
+                    cursor.execute('release stmt')
+            cursor.execute('commit')
+        except Exception, e:
+            try:
+                conn and conn.rollback()
+            except Exception:
+                pass
+            for req in batch:
+                if req.error is None:
+                    req.error = e
+        finally:
+            if cursor:
+                cursor.close()
+            if conn:
+                conn.isolation_level = level
+                self._pool.release(conn)
+        with self._lock:
+            self.commit_latency.add((time.time() - start) * 1000)
+            self.batch_size.add(len(batch))
+        for req in batch:
+            req.done.set()
+
+    def stats(self):
+        with self._lock:
+            return Dict(commit_latency_ms=self.commit_latency.to_dict(),
+                        batch_size=self.batch_size.to_dict())
+
+def enable_group_commit(window=0.002,max_batch=64):
+    """
+    Funnel writes made outside transactions through a single writer thread
+    which commits them in batches. Each caller still gets its own rowcount
+    or exception
+
+    """
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    disable_group_commit()
+    engine.group_commit = _GroupCommitter(engine.pool,window,max_batch)
+
+def disable_group_commit():
+    if engine is None:
+        raise DBError('Engine is not initialized')
+    if engine.group_commit is not None:
+        engine.group_commit.stop()
+        engine.group_commit = None
+
+def group_commit_stats():
+    """
+    Return commit latency and batch size histograms or None if group commit
+    is disabled
+
+    """
+    if engine is None or engine.group_commit is None:
+        return None
+    return engine.group_commit.stats()
+
+#functions called with the tables changed by each write
+_write_listeners = []
+
+def add_write_listener(listener):
+    """
+    Register listener, called with the tuple of lower case table names a
+    write statement changed, or None if unknown, once the write is committed.
+    Used to invalidate caches built on top of the database
+
+    """
+    if not listener in _write_listeners:
+        _write_listeners.append(listener)
+
+def remove_write_listener(listener):
+    if listener in _write_listeners:
+        _write_listeners.remove(listener)
+
+def _record_write(sql):
+    """
+    Invalidate cached results depending on the tables written by sql, inside
+    a transaction this is deferred until it ends
+
+    """
+    global _db_ctx
+    tables = _write_tables(sql)
+    if _db_ctx.transactions > 0:
+        _db_ctx.written.append(tables)
+    else:
+        _invalidate(tables)
+
+def _flush_writes():
+    global _db_ctx
+    written = _db_ctx.written
+    _db_ctx.written = []
+    for tables in written:
+        _invalidate(tables)
+
+def _invalidate(tables):
+    if engine.query_cache is not None:
+        engine.query_cache.invalidate(tables)
+    for listener in list(_write_listeners):
+        try:
+            listener(tables)
+        except Exception:
+            logging.exception('Write listener %r failed' % listener)
 
 class _ConnectionCtx(object):
     """
@@ -118,25 +930,52 @@ class _ConnectionCtx(object):
                 pass
 
     """
+    def __init__(self,identity_map=False):
+        self.identity_map = identity_map
+
     def __enter__(self):
         global _db_ctx
         self.should_cleanup = False
         if not _db_ctx.is_init():
             _db_ctx.init()
             self.should_cleanup = True
+        self.should_drop_map = _enter_identity_map(self.identity_map)
         return self
     
     def __exit__(self,exctype,excvalue,traceback):
         global _db_ctx
+        if self.should_drop_map:
+            _db_ctx.identity_map = None
         if self.should_cleanup:
             _db_ctx.cleanup()
 
-def connection():
+def _enter_identity_map(enabled):
+    """
+    Install an identity map on the current context if enabled and none is
+    installed yet, return True if the caller owns the new map
+
     """
-    Return _ConnectionCtx object
+    global _db_ctx
+    if enabled and _db_ctx.identity_map is None:
+        _db_ctx.identity_map = _IdentityMap()
+        return True
+    return False
 
+def get_identity_map():
     """
-    return _ConnectionCtx()
+    Return the identity map of the current context or None
+
+    """
+    global _db_ctx
+    return _db_ctx.identity_map
+
+def connection(identity_map=False):
+    """
+    Return _ConnectionCtx object, with identity_map objects loaded by primary
+    key are reused inside the context
+
+    """
+    return _ConnectionCtx(identity_map)
 
 def with_connection(func):
     """
@@ -157,6 +996,9 @@ class _TransactionCtx(object):
         pass
 
     """
+    def __init__(self,identity_map=False):
+        self.identity_map = identity_map
+
     def __enter__(self):
         global _db_ctx
         self.should_close_conn = False
@@ -164,6 +1006,7 @@ class _TransactionCtx(object):
             _db_ctx.init()
             self.should_close_conn = True
         _db_ctx.transactions = _db_ctx.transactions + 1
+        self.should_drop_map = _enter_identity_map(self.identity_map)
         return self
         
     def __exit__(self,exctype,excvalue,traceback):
@@ -176,27 +1019,36 @@ class _TransactionCtx(object):
                 else:
                     self.rollback()
         finally:
+            if _db_ctx.transactions == 0 and _db_ctx.written:
+                _flush_writes()
+            if self.should_drop_map:
+                _db_ctx.identity_map = None
             if self.should_close_conn:
                 _db_ctx.cleanup()
+            elif _db_ctx.transactions == 0:
+                _db_ctx.connection.release_writer()
 
     def commit(self):
         global _db_ctx
         try:
             _db_ctx.connection.commit()
         except:
-            _db_ctx.connection.rollback()
+            self.rollback()
             raise
 
     def rollback(self):
         global _db_ctx
+        #loaded objects may hold rolled back changes
+        if _db_ctx.identity_map is not None:
+            _db_ctx.identity_map.clear()
         _db_ctx.connection.rollback()
 
-def transaction():
+def transaction(identity_map=False):
     """
     Create a transaction object
 
     """
-    return _TransactionCtx()
+    return _TransactionCtx(identity_map)
 
 def with_transaction(func):
     """
@@ -209,24 +1061,268 @@ def with_transaction(func):
             return func(*args,**kw)
     return _wrapper
     
+#functions called with a Dict describing every executed statement
+_listeners = []
+
+def add_listener(listener):
+    """
+    Register listener, called after each statement with a Dict holding sql,
+    args_shape (the type names of the arguments), duration in seconds,
+    rowcount and in_transaction. Without listeners nothing is measured. A
+    DBError raised by a listener fails a select, other exceptions and any
+    raised after a write, which is already done, are logged
+
+    """
+    if not listener in _listeners:
+        _listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def _notify(sql,args,start,rowcount,write=False):
+    global _db_ctx
+    event = Dict(sql=sql,args_shape=tuple([type(a).__name__ for a in args]),
+                 duration=time.time() - start,rowcount=rowcount,
+                 in_transaction=_db_ctx.transactions > 0)
+    for listener in list(_listeners):
+        try:
+            listener(event)
+        except Exception, e:
+            if isinstance(e,DBError) and not write:
+                raise
+            logging.exception('Query listener %r failed' % listener)
+
+_RE_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_RE_SPACES = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """
+    Return sql with literals replaced by ? and in lists collapsed, so that
+    statements differing only in values share one fingerprint
+
+    Usage:
+        fingerprint("select * from user where id in (1,2,3) and name='x'")
+        'select * from user where id in (...) and name=?'
+    """
+    sql = _RE_LITERALS.sub('?',sql)
+    sql = _RE_IN_LIST.sub('(...)',sql)
+    return _RE_SPACES.sub(' ',sql).strip()
+
+class QueryStats(object):
+    """
+    Listener aggregating calls, total time and percentiles per statement
+    fingerprint, keeping the last samples durations of each
+
+    Usage:
+        stats = QueryStats()
+        add_listener(stats)
+        stats.report()
+    """
+    def __init__(self,samples=1000):
+        self.samples = samples
+        self._stats = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self,event):
+        fp = self._fingerprints.get(event.sql)
+        if fp is None:
+            if len(self._fingerprints) > 4096:
+                self._fingerprints.clear()
+            fp = self._fingerprints[event.sql] = fingerprint(event.sql)
+        with self._lock:
+            s = self._stats.get(fp)
+            if s is None:
+                s = self._stats[fp] = [0,0.0,0,collections.deque(maxlen=self.samples)]
+            s[0] = s[0] + 1
+            s[1] = s[1] + event.duration
+            s[2] = s[2] + max(event.rowcount,0)
+            s[3].append(event.duration)
+
+    def report(self):
+        """
+        Return a list of Dict per fingerprint, the most expensive first
+
+        """
+        with self._lock:
+            items = [(fp,s[0],s[1],s[2],sorted(s[3])) for fp,s in self._stats.iteritems()]
+        L = []
+        for fp,calls,total,rows,samples in items:
+            L.append(Dict(fingerprint=fp,calls=calls,total=total,rows=rows,
+                          mean=total / calls,
+                          p50=samples[int(0.50 * (len(samples) - 1))],
+                          p99=samples[int(0.99 * (len(samples) - 1))]))
+        L.sort(key=lambda d: d.total,reverse=True)
+        return L
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+class SlowQueryLog(object):
+    """
+    Listener logging statements slower than threshold seconds
+
+    """
+    def __init__(self,threshold=0.1,logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('transwarp.db')
+
+    def __call__(self,event):
+        if event.duration >= self.threshold:
+            self.logger.warning('slow query %.1f ms, %s rows%s: %s %r' %
+                                (event.duration * 1000,event.rowcount,
+                                 event.in_transaction and ', in transaction' or '',
+                                 event.sql,event.args_shape))
+
+class QueryPlanError(DBError):
+    pass
+
+_RE_AUDITED = re.compile(r'^\s*(select|update|delete|with)\b',re.I)
+_RE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+class QueryPlanAuditor(object):
+    """
+    Listener running EXPLAIN QUERY PLAN for each distinct statement the first
+    time it is seen. Full scans of tables holding at least min_rows rows and
+    temporary b-trees for ORDER BY are recorded as issues, with fail set a
+    select raises QueryPlanError. Meant for development and tests
+
+    Usage:
+        auditor = QueryPlanAuditor(min_rows=1000)
+        add_listener(auditor)
+        ...
+        auditor.write_report('plans.txt')
+        auditor.check()
+    """
+    def __init__(self,min_rows=1000,fail=False):
+        self.min_rows = min_rows
+        self.fail = fail
+        self.issues = []
+        self._seen = set()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __call__(self,event):
+        sql = event.sql
+        if sql in self._seen or not _RE_AUDITED.match(sql):
+            return
+        with self._lock:
+            if sql in self._seen:
+                return
+            self._seen.add(sql)
+        #explain on the connection of the statement, the pool may have no other
+        with _ConnectionCtx():
+            cursor = _db_ctx.connection.cursor(not event.in_transaction)
+            try:
+                issues = self._audit(cursor,sql,event.args_shape)
+            finally:
+                cursor.close()
+        if issues:
+            with self._lock:
+                self.issues.extend(issues)
+            #a write is already done, it is only reported
+            if self.fail and _RE_AUDITED.match(sql).group(1).lower() in ('select','with'):
+                raise QueryPlanError('%s: %s' % (issues[0].problem,sql))
+
+    def _audit(self,cursor,sql,args_shape):
+        try:
+            #only the plan matters, any values of the right count do
+            plan = cursor.execute('explain query plan %s' % sql,[None] * len(args_shape)).fetchall()
+        except Exception:
+            return []
+        issues = []
+        for row in plan:
+            detail = row[-1]
+            m = _RE_SCAN.match(detail)
+            if m:
+                rows = self._table_size(cursor,m.group(1))
+                if rows is not None and rows >= self.min_rows:
+                    issues.append(Dict(sql=sql,problem='full table scan',detail=detail,
+                                       table=m.group(1),rows=rows))
+            elif detail.startswith('USE TEMP B-TREE FOR') and 'ORDER BY' in detail:
+                issues.append(Dict(sql=sql,problem='temporary b-tree for order by',
+                                   detail=detail,table=None,rows=None))
+        return issues
+
+    def _table_size(self,cursor,table):
+        if not table in self._sizes:
+            try:
+                self._sizes[table] = cursor.execute('select count(*) from `%s`' % table).fetchone()[0]
+            except Exception:
+                self._sizes[table] = None
+        return self._sizes[table]
+
+    def report(self):
+        """
+        Return the issues as text, one per line
+
+        """
+        return '\n'.join(['%s [%s] %s' % (i.problem,i.detail,i.sql) for i in self.issues])
+
+    def write_report(self,path):
+        with open(path,'w') as f:
+            f.write(self.report())
+            f.write('\n')
+
+    def check(self):
+        """
+        Raise QueryPlanError if any issue was found
+
+        """
+        if self.issues:
+            raise QueryPlanError('%d query plan issues:\n%s' % (len(self.issues),self.report()))
+
 def _select(sql,first,*args):
     """
-    Execute sql statement and return result list or one result
+    Execute sql statement and return result list or one result, going through
+    the query cache when it is enabled and no transaction is open
 
     """
+    global _db_ctx
+    cache = engine.query_cache
+    if cache is None or _db_ctx.transactions > 0:
+        return _do_select(sql,first,*args)
+    key = (sql,first,args)
+    try:
+        hash(key)
+    except TypeError:
+        return _do_select(sql,first,*args)
+    tables = cache.tables(sql)
+    hit,value = cache.get(key,tables)
+    if hit:
+        return value if first else list(value)
+    snapshot = cache.snapshot(tables)
+    value = _do_select(sql,first,*args)
+    cache.put(key,tables,snapshot,value)
+    return value if first else list(value)
+
+def _do_select(sql,first,*args):
     global _db_ctx
     cursor = None
+    start = _listeners and time.time()
     try:
-        cursor = _db_ctx.connection.cursor()
+        #reads inside a transaction must see its writes
+        cursor = _db_ctx.connection.cursor(_db_ctx.transactions == 0)
         cursor.execute(sql,args)
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-        if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names,values)
-        return [Dict(names,x) for x in cursor.fetchall()]
+        if not cursor.description:
+            #statements like pragma assignments return no rows
+            result = None if first else []
+            rowcount = 0
+        else:
+            make_row = engine.row_factory([x[0] for x in cursor.description])
+            if first:
+                values = cursor.fetchone()
+                result = values and make_row(values) or None
+                rowcount = values and 1 or 0
+            else:
+                result = map(make_row,cursor.fetchall())
+                rowcount = len(result)
+        if start:
+            _notify(sql,args,start,rowcount)
+        return result
 
     finally:
         
@@ -249,9 +1345,68 @@ def select_all(sql,*args):
     """
     return _select(sql,False,*args)
     
+def select_iter(sql,*args,**kw):
+    """
+    Execute select SQL and return a generator of rows, fetching batch_size rows
+    (default 100) at a time. The connection stays checked out only while the
+    generator is alive and the cursor is closed when it is exhausted or closed
+
+    Usage:
+        for row in select_iter('select * from user where age>?',10,batch_size=500):
+            pass
+
+    """
+    global _db_ctx
+    batch_size = kw.pop('batch_size',100)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+    conn = None
+    lazy = None
+    cursor = None
+    start = _listeners and time.time()
+    rowcount = 0
+    try:
+        if _db_ctx.is_init():
+            #keep the context connection checked out until we are done
+            lazy = _db_ctx.connection
+            lazy.pin()
+            cursor = lazy.cursor(_db_ctx.transactions == 0)
+        else:
+            #do not touch the thread local context, its lifetime is not tied to ours
+            conn = engine.connect(read=True)
+            cursor = conn.cursor()
+        cursor.execute(sql,args)
+        if not cursor.description:
+            return
+        make_row = engine.row_factory([x[0] for x in cursor.description])
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            rowcount = rowcount + len(rows)
+            for values in rows:
+                yield make_row(values)
+    finally:
+        if cursor:
+            cursor.close()
+        if conn:
+            engine.release(conn,read=True)
+        if lazy:
+            lazy.unpin()
+        if start:
+            _notify(sql,args,start,rowcount)
+
 @with_connection
 def _update(sql,*args):
     global _db_ctx
+    start = _listeners and time.time()
+    if _db_ctx.transactions == 0 and engine.group_commit is not None:
+        r = engine.group_commit.execute(sql,args)
+        if engine.query_cache is not None or _write_listeners:
+            _record_write(sql)
+        if start:
+            _notify(sql,args,start,r,True)
+        return r
     cursor = None
     try:
         cursor = _db_ctx.connection.cursor()
@@ -259,10 +1414,17 @@ def _update(sql,*args):
         r = cursor.rowcount
         if _db_ctx.transactions == 0:
             _db_ctx.connection.commit()
+        #caches must forget the write even if a listener fails
+        if engine.query_cache is not None or _write_listeners:
+            _record_write(sql)
+        if start:
+            _notify(sql,args,start,r,True)
         return r
     finally:
         if cursor:
             cursor.close()
+        if _db_ctx.transactions == 0:
+            _db_ctx.connection.release_writer()
 
 def update(sql,*args):
     
@@ -274,3 +1436,36 @@ def insert(table,**kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for  col in cols]), ','.join(['?' for i in range(len(cols))]))  
 
     return _update(sql,*args)
+
+def insert_many(table,rows,chunk_size=500):
+    """
+    Insert a list of dicts sharing the same keys into table with executemany,
+    chunk_size rows at a time inside one transaction. Return the number of
+    inserted rows
+
+    """
+    if not rows:
+        return 0
+    cols = list(rows[0].keys())
+    sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+    return _update_many(sql,[[row[col] for col in cols] for row in rows],chunk_size)
+
+@with_transaction
+def _update_many(sql,seq,chunk_size):
+    global _db_ctx
+    cursor = None
+    try:
+        cursor = _db_ctx.connection.cursor()
+        r = 0
+        for i in range(0,len(seq),chunk_size):
+            start = _listeners and time.time()
+            cursor.executemany(sql,seq[i:i + chunk_size])
+            r = r + cursor.rowcount
+            if start:
+                _notify(sql,seq[i],start,cursor.rowcount,True)
+        if engine.query_cache is not None or _write_listeners:
+            _record_write(sql)
+        return r
+    finally:
+        if cursor:
+            cursor.close()
@@ -3,6 +3,7 @@
 """
 ORM operations module
 """
+import base64,json
 import db
 
 class Field(object):
@@ -14,6 +15,9 @@ class Field(object):
         self.nullable = kw.get('nullable',False)
         self.updatable = kw.get('updatable',True)
         self.insertable = kw.get('insertable',True)
+        self.index = kw.get('index',False)
+        self.unique = kw.get('unique',False)
+        self.deferred = kw.get('deferred',False)
         self.ddl = kw.get('ddl','')
         #_order is used to sort added Field, so that they can be shown in the order
         # that they are added
@@ -87,6 +91,288 @@ class VersionField(Field):
     def __init__(self,name=None):
         super(VersionField,self).__init__(name=name,default=0,ddl='bigint')
 
+class Relation(object):
+    """
+    Base class of relations between models. A relation is a class attribute
+    loading the related objects on first access, prefetch loads them for a
+    list of objects at once. The target model may be given by class name,
+    looked up in the module of the relation, or by module.ClassName
+    """
+    def __init__(self,model,key):
+        self._model = model
+        self.key = key
+        self.name = None
+        self.module = None
+
+    @property
+    def model(self):
+        if isinstance(self._model,basestring):
+            module,dot,name = self._model.rpartition('.')
+            key = (module or self.module,name)
+            if not key in _models:
+                raise TypeError('Unknown model %s in relation %s' % (self._model,self.name))
+            self._model = _models[key]
+        return self._model
+
+    def __get__(self,obj,cls):
+        if obj is None:
+            return self
+        #cached in the instance __dict__ which hides this descriptor afterwards
+        value = obj.__dict__[self.name] = self.load(obj)
+        return value
+
+class BelongsTo(Relation):
+    """
+    The related object is the one whose primary key is stored in key
+
+    Usage:
+        class Blog(Model):
+            user = BelongsTo('User','user_id')
+    """
+    def load(self,obj):
+        return self.model.get(obj[self.key])
+
+    def prefetch(self,objs):
+        related = self.model.get_many([obj[self.key] for obj in objs])
+        for obj in objs:
+            obj.__dict__[self.name] = related.get(obj[self.key])
+        return related.values()
+
+class HasMany(Relation):
+    """
+    The related objects are the ones storing our primary key in key
+
+    Usage:
+        class Blog(Model):
+            comments = HasMany('Comment','blog_id','order by created_at')
+    """
+    def __init__(self,model,key,order_by=''):
+        super(HasMany,self).__init__(model,key)
+        self.order_by = order_by
+
+    def load(self,obj):
+        return self.model.find_by('where `%s`=? %s' % (self.key,self.order_by),
+                                  obj[obj.__primary_key__.name])
+
+    def prefetch(self,objs):
+        if not objs:
+            return []
+        pk = objs[0].__primary_key__.name
+        groups = {}
+        for obj in objs:
+            groups[obj[pk]] = []
+        keys = groups.keys()
+        related = []
+        for i in range(0,len(keys),_max_variables):
+            chunk = keys[i:i + _max_variables]
+            related.extend(self.model.find_by('where `%s` in (%s) %s' %
+                           (self.key,','.join(['?'] * len(chunk)),self.order_by),*chunk))
+        #prefetched lists keep order_by within each group
+        for r in related:
+            groups[r[self.key]].append(r)
+        for obj in objs:
+            obj.__dict__[self.name] = groups[obj[pk]]
+        return related
+
+#compiled select statements of Query objects keyed by query shape
+_compiled = {}
+
+class Query(object):
+    """
+    Chainable query of a model. Every call returns a new Query, the SQL is
+    compiled once per query shape and cached. Order fields prefixed with -
+    are sorted descending
+
+    Usage:
+        q = Blog.query().where('user_id=?',uid).order_by('-created_at','-id').defer('content')
+        blogs = q.limit(10).all()
+        blogs,cursor = q.page(10)
+        blogs,cursor = q.page(10,cursor)
+    """
+    def __init__(self,model):
+        self._model = model
+        self._where = ()
+        self._args = ()
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._prefetch = ()
+        self._deferred = model.__deferred__
+
+    def _clone(self,**kw):
+        q = Query.__new__(Query)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(kw)
+        return q
+
+    def where(self,clause,*args):
+        return self._clone(_where=self._where + (clause,),_args=self._args + args)
+
+    def order_by(self,*fields):
+        order = []
+        for f in fields:
+            desc = f.startswith('-')
+            order.append((self._model._column(desc and f[1:] or f),desc))
+        return self._clone(_order=tuple(order))
+
+    def limit(self,n):
+        return self._clone(_limit=n)
+
+    def offset(self,n):
+        return self._clone(_offset=n)
+
+    def prefetch(self,*names):
+        return self._clone(_prefetch=self._prefetch + names)
+
+    def only(self,*fields):
+        """
+        Load only fields and the primary key, the others are deferred
+        """
+        for f in fields:
+            self._model._column(f)
+        keep = set(fields)
+        keep.add(self._model.__primary_key__.name)
+        return self._clone(_deferred=frozenset([k for k in self._model.__mappings__ if not k in keep]))
+
+    def defer(self,*fields):
+        """
+        Leave fields out of the select, they are loaded on first access
+        """
+        for f in fields:
+            self._model._column(f)
+            if self._model.__mappings__[f].primary_key:
+                raise ValueError('Primary key can not be deferred')
+        return self._clone(_deferred=self._deferred | frozenset(fields))
+
+    def _select(self):
+        return _select_list(self._model.__mappings__,self._deferred)
+
+    def _compile(self,select,seek=None,paginate=True):
+        """
+        Return the SQL for this query shape, seek is the order of a keyset page
+        """
+        has_limit = paginate and self._limit is not None
+        has_offset = paginate and self._offset is not None
+        key = (self._model.__table__,select,self._where,self._order,has_limit,has_offset,seek)
+        sql = _compiled.get(key)
+        if sql is not None:
+            return sql
+        where = ['(%s)' % w for w in self._where]
+        if seek:
+            where.append(_seek_clause(seek))
+        sql = ['select %s from `%s`' % (select,self._model.__table__)]
+        where and sql.append('where %s' % ' and '.join(where))
+        if self._order and not select.startswith('count('):
+            sql.append('order by %s' % ','.join(['`%s`%s' % (c,desc and ' desc' or '')
+                                                   for c,desc in self._order]))
+        has_limit and sql.append('limit ?')
+        has_offset and sql.append(has_limit and 'offset ?' or 'limit -1 offset ?')
+        #where clauses holding values would grow it without end
+        if len(_compiled) > 4096:
+            _compiled.clear()
+        sql = _compiled[key] = ' '.join(sql)
+        return sql
+
+    def _paging_args(self):
+        args = []
+        self._limit is not None and args.append(self._limit)
+        self._offset is not None and args.append(self._offset)
+        return args
+
+    def all(self):
+        L = db.select_all(self._compile(self._select()),*(self._args + tuple(self._paging_args())))
+        return self._model.prefetch(self._model._load(L,self._deferred),*self._prefetch)
+
+    def first(self):
+        L = self.limit(1).all()
+        return L[0] if L else None
+
+    def count(self):
+        d = db.select_one(self._compile('count(*) as `count`',paginate=False),*self._args)
+        return d['count']
+
+    def __iter__(self):
+        deferred = self._deferred
+        for d in db.select_iter(self._compile(self._select()),
+                                *(self._args + tuple(self._paging_args()))):
+            obj = self._model._from_row(d)
+            if deferred:
+                obj._set_deferred(deferred)
+            yield obj
+
+    def page(self,size,cursor=None):
+        """
+        Return a page of at most size objects after the cursor token and the
+        token of the next page, or None on the last page. The query order is
+        completed with the primary key so that it is unique
+        """
+        pk = self._model.__primary_key__.name
+        order = self._order
+        if not pk in [c for c,desc in order]:
+            order = order + ((pk,order and order[-1][1] or False),)
+        #the cursor is built from the order fields so they can not be deferred
+        q = self._clone(_order=order,_limit=size + 1,_offset=None,
+                        _deferred=self._deferred - frozenset([c for c,desc in order]))
+        args = q._args
+        if cursor is not None:
+            values = _decode_cursor(cursor,len(order))
+            sql = q._compile(q._select(),seek=order)
+            args = args + _seek_args(order,values)
+        else:
+            sql = q._compile(q._select())
+        L = self._model._load(db.select_all(sql,*(args + (size + 1,))),q._deferred)
+        next_cursor = None
+        if len(L) > size:
+            L = L[:size]
+            next_cursor = _encode_cursor([L[-1][c] for c,desc in order])
+        return self._model.prefetch(L,*self._prefetch),next_cursor
+
+def _seek_clause(order):
+    """
+    Return the where clause selecting rows after a keyset position
+    """
+    cols = ['`%s`' % c for c,desc in order]
+    if len(set([desc for c,desc in order])) == 1:
+        #a row value comparison can be answered from an index on the columns
+        return '(%s) %s (%s)' % (','.join(cols),order[0][1] and '<' or '>',
+                                 ','.join(['?'] * len(cols)))
+    L = []
+    for i,(c,desc) in enumerate(order):
+        eq = ['%s=?' % col for col in cols[:i]]
+        eq.append('%s%s?' % (cols[i],desc and '<' or '>'))
+        L.append('(%s)' % ' and '.join(eq))
+    return '(%s)' % ' or '.join(L)
+
+def _seek_args(order,values):
+    if len(set([desc for c,desc in order])) == 1:
+        return tuple(values)
+    args = []
+    for i in range(len(order)):
+        args.extend(values[:i + 1])
+    return tuple(args)
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def _decode_cursor(cursor,n):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError,ValueError):
+        raise ValueError('Invalid cursor %r' % cursor)
+    if not isinstance(values,list) or len(values) != n:
+        raise ValueError('Invalid cursor %r' % cursor)
+    return values
+
+#model classes by (module,name), used to resolve relations
+_models = {}
+
+#maximum number of host parameters in a statement, SQLITE_MAX_VARIABLE_NUMBER
+#defaults to 999 before SQLite 3.32
+_max_variables = 999
+
+#aggregate functions supported by Model.aggregate
+_aggregates = frozenset(['count','sum','min','max','avg'])
+
 #triggers sending signals before some specific operations
 _triggers = frozenset(['pre_update','pre_insert','pre_delete'])
 
@@ -105,8 +391,13 @@ class ModelMetaclass(type):
             cls.subclasses[name] = name
 
         mappings = {}
+        relations = {}
         primary_key = None
         for k,v in attrs.iteritems():
+            if isinstance(v,Relation):
+                v.name = k
+                v.module = attrs.get('__module__')
+                relations[k] = v
             if isinstance(v,Field):
                 #if data table column name does not set, then set it as same as attribute
                 if not v.name:
@@ -119,6 +410,8 @@ class ModelMetaclass(type):
                         raise TypeError("Primary key can not be set as updatable")
                     if v.nullable:
                         raise TypeError("Primary key can not be set as nullable")
+                    if v.deferred:
+                        raise TypeError("Primary key can not be set as deferred")
                     primary_key = v
                 mappings[k] = v
         #check existence of primary key
@@ -131,13 +424,30 @@ class ModelMetaclass(type):
         if not '__table__' in attrs:
             attrs['__table__']  =  name.lower()
         attrs['__mappings__'] =  mappings
+        attrs['__relations__'] = relations
+        #fields left out of default selects and loaded on first access
+        attrs['__deferred__'] = frozenset([k for k,v in mappings.iteritems() if v.deferred])
+        attrs['__select__'] = _select_list(mappings,attrs['__deferred__'])
         attrs['__primary_key__'] = primary_key
         attrs['__sql__'] = _create_table(attrs['__table__'],mappings)
+        attrs['__index_sql__'] = _create_indexes(attrs['__table__'],mappings,
+                                                 attrs.get('__indexes__',()),
+                                                 attrs.get('__unique_indexes__',()))
+        #precomputed defaults used by Model.__init__, callable defaults are
+        #evaluated per object
+        attrs['__field_defaults__'] = dict([(k,v._default) for k,v in mappings.iteritems()
+                                            if not callable(v._default)])
+        attrs['__callable_defaults__'] = tuple([(k,v._default) for k,v in mappings.iteritems()
+                                                if callable(v._default)])
+        if '__init__' in attrs:
+            #a custom constructor must also run for objects loaded from database
+            attrs['_from_row'] = classmethod(lambda cls,row: cls(**row)._mark_clean())
         #add trigger methods 
         for t in _triggers:
             if not t in attrs:
                 attrs[t] = None
-        return type.__new__(cls,name,bases,attrs)
+        model = _models[(attrs.get('__module__'),name)] = type.__new__(cls,name,bases,attrs)
+        return model
  
 class Model(dict):
    """
@@ -146,11 +456,49 @@ class Model(dict):
     enabled in the definition of this class
    """
    __metaclass__ = ModelMetaclass
+   #names of fields modified since load or last save, None if the object was
+   #not loaded from database so every field is considered modified
+   _dirty = None
+   #names of fields not loaded yet
+   _deferred = None
+
    def __init__ (self,**kw):
-        super(Model,self).__init__(**kw)
-        for k,v in self.__mappings__.iteritems():
-            if not hasattr(self,k):
-                setattr(self,k,v.default)
+        super(Model,self).__init__(self.__field_defaults__,**kw)
+        for k,f in self.__callable_defaults__:
+            if not k in kw:
+                self[k] = f()
+
+   @classmethod
+   def _from_row(cls,row):
+        """
+        Build an object from a database row, skipping defaults evaluation
+        """
+        obj = dict.__new__(cls)
+        dict.update(obj,row)
+        obj.__dict__['_dirty'] = set()
+        return obj
+
+   def _mark_clean(self):
+        self.__dict__['_dirty'] = set()
+        return self
+
+   def _set_deferred(self,deferred):
+        """
+        Mark the fields left out of the select as deferred, dropping the
+        defaults a custom constructor gave them
+        """
+        self.__dict__['_deferred'] = set(deferred)
+        for k in deferred:
+            dict.pop(self,k,None)
+        return self
+
+   def dirty_fields(self):
+        """
+        Return the names of fields modified since load or last save
+        """
+        if self._dirty is None:
+            return frozenset(self.__mappings__)
+        return frozenset(self._dirty)
 
    def __getattr__(self,key):
         try:
@@ -161,44 +509,203 @@ class Model(dict):
    def __setattr__(self,key,value):
         self[key] = value
 
+   def __missing__(self,key):
+        deferred = self._deferred
+        if deferred and key in deferred:
+            self.undefer([self])
+            if dict.__contains__(self,key):
+                return dict.__getitem__(self,key)
+        raise KeyError(key)
+
+   def __setitem__(self,key,value):
+        dirty = self._dirty
+        if dirty is not None and key in self.__mappings__ and \
+                (not key in self or dict.__getitem__(self,key) != value):
+            dirty.add(key)
+        deferred = self._deferred
+        if deferred:
+            deferred.discard(key)
+        dict.__setitem__(self,key,value)
+
    @classmethod
    def get(cls,pk):
         """
-        Get by primary key
+        Get by primary key, inside a context with an identity map an object
+        already loaded is returned without querying
         """
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__,
+        imap = db.get_identity_map()
+        if imap is not None:
+            obj = imap.get((cls.__table__,pk))
+            if obj is not None:
+                return obj
+        d = db.select_one('select %s from %s where %s=?' % (cls.__select__,cls.__table__,
                           cls.__primary_key__.name),pk)
-        return cls(**d) if d else None
+        return cls._load([d])[0] if d else None
+   @classmethod
+   def query(cls):
+        """
+        Return a chainable Query of this model
+        """
+        return Query(cls)
+
+   @classmethod
+   def get_many(cls,pks,ordered=False,chunk_size=None):
+        """
+        Get by a list of primary keys with chunked `in` queries, duplicate keys
+        are loaded once. Return a dict keyed by primary key, or if ordered is set
+        a list following pks with None for missing keys
+        """
+        chunk_size = chunk_size or _max_variables
+        found = {}
+        keys = []
+        imap = db.get_identity_map()
+        for pk in pks:
+            if pk in found:
+                continue
+            obj = imap.get((cls.__table__,pk)) if imap is not None else None
+            found[pk] = obj
+            if obj is None:
+                keys.append(pk)
+        pk_name = cls.__primary_key__.name
+        for i in range(0,len(keys),chunk_size):
+            chunk = keys[i:i + chunk_size]
+            L = db.select_all('select %s from `%s` where `%s` in (%s)' %
+                              (cls.__select__,cls.__table__,pk_name,','.join(['?'] * len(chunk))),*chunk)
+            for obj in cls._load(L):
+                found[obj[pk_name]] = obj
+        if ordered:
+            return [found[pk] for pk in pks]
+        return dict([(k,v) for k,v in found.iteritems() if v is not None])
+
    @classmethod
    def find_one(cls,where,*args):
         """
          Find the one suject to the where clause
         """
-        d = db.select_one('select * from %s %s' % (cls.__table__,where), *args)
-        return cls(**d) if d else None
+        d = db.select_one('select %s from %s %s' % (cls.__select__,cls.__table__,where), *args)
+        return cls._load([d])[0] if d else None
 
    @classmethod
-   def find_all(cls):
+   def find_all(cls,prefetch=()):
         """
-        Find all and return list
+        Find all and return list, relations named in prefetch are loaded with
+        one extra query each
         """
-        d = db.select_all('select * from `%s`' % cls.__table__)
-        return [cls(**l) for l in d]
+        d = db.select_all('select %s from `%s`' % (cls.__select__,cls.__table__))
+        return cls.prefetch(cls._load(d),*prefetch)
 
    @classmethod
-   def find_by(cls,where,*args):
+   def find_by(cls,where,*args,**kw):
         """
-        Find by where clause and return list
+        Find by where clause and return list, a prefetch keyword works as in
+        find_all
         """
-        L =  db.select_all('select * from `%s` %s' % (cls.__table__,where), *args)
-        return [cls(**t) for t in L]
+        prefetch = kw.pop('prefetch',())
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+        L =  db.select_all('select %s from `%s` %s' % (cls.__select__,cls.__table__,where), *args)
+        return cls.prefetch(cls._load(L),*prefetch)
+
+   @classmethod
+   def prefetch(cls,objs,*names):
+        """
+        Load the named relations of all objs at once and attach them to the
+        objects. Nested relations are separated by dots
+
+        Usage:
+            Blog.prefetch(blogs,'user','comments.user')
+        """
+        for name in names:
+            head,sep,rest = name.partition('.')
+            if not head in cls.__relations__:
+                raise AttributeError('%s has no relation %s' % (cls.__name__,head))
+            relation = cls.__relations__[head]
+            related = relation.prefetch(objs)
+            if rest and related:
+                relation.model.prefetch(related,rest)
+        return objs
+
+   @classmethod
+   def _load(cls,rows,deferred=None):
+        """
+        Build objects from rows, reusing objects of the identity map if any.
+        deferred are the fields missing from rows, the model default if None
+        """
+        if deferred is None:
+            deferred = cls.__deferred__
+        L = map(cls._from_row,rows)
+        if deferred:
+            for obj in L:
+                obj._set_deferred(deferred)
+        imap = db.get_identity_map()
+        if imap is None:
+            return L
+        pk = cls.__primary_key__.name
+        return [imap.merge((cls.__table__,obj[pk]),obj) for obj in L]
+
+   @classmethod
+   def undefer(cls,objs,*fields):
+        """
+        Load deferred fields of objs with one query per 999 objects, all the
+        deferred fields if none are given
+        """
+        pk = cls.__primary_key__.name
+        pending = {}
+        wanted = set(fields)
+        for obj in objs:
+            if obj._deferred:
+                pending.setdefault(obj[pk],[]).append(obj)
+                fields or wanted.update(obj._deferred)
+        if not pending:
+            return objs
+        cols = [(k,cls._column(k)) for k in wanted]
+        keys = pending.keys()
+        for i in range(0,len(keys),_max_variables):
+            chunk = keys[i:i + _max_variables]
+            L = db.select_all('select `%s`,%s from `%s` where `%s` in (%s)' %
+                              (pk,','.join(['`%s`' % c for k,c in cols]),cls.__table__,pk,
+                               ','.join(['?'] * len(chunk))),*chunk)
+            for d in L:
+                for obj in pending[d[pk]]:
+                    for k,c in cols:
+                        if k in obj._deferred:
+                            dict.__setitem__(obj,k,d[c])
+                            obj._deferred.discard(k)
+        return objs
+
+   @classmethod
+   def iter_all(cls,batch_size=100):
+        """
+        Iterate over all objects without loading the whole table
+        """
+        deferred = cls.__deferred__
+        for d in db.select_iter('select %s from `%s`' % (cls.__select__,cls.__table__),
+                                batch_size=batch_size):
+            obj = cls._from_row(d)
+            if deferred:
+                obj._set_deferred(deferred)
+            yield obj
+
+   @classmethod
+   def iter_by(cls,where,*args,**kw):
+        """
+        Iterate over objects subject to the where clause, batch_size may be
+        passed as keyword
+        """
+        deferred = cls.__deferred__
+        for d in db.select_iter('select %s from `%s` %s' % (cls.__select__,cls.__table__,where),
+                                *args,**kw):
+            obj = cls._from_row(d)
+            if deferred:
+                obj._set_deferred(deferred)
+            yield obj
 
    @classmethod
    def count_all(cls):
         """
         Find by 'select count(pk) from table' and return integer
         """
-        return len(cls.find_all())
+        return cls.aggregate('count')
 
    @classmethod
    def count_by(cls,where,*args):
@@ -206,20 +713,61 @@ class Model(dict):
         Find by 'select count(pk) from table where ...
 
         """
-        return len(cls.find_by(where,*args))
+        return cls.aggregate('count','*',where,*args)
+
+   @classmethod
+   def aggregate(cls,func,field='*',where='',*args,**kw):
+        """
+        Run one of count, sum, min, max, avg over field in a single statement.
+        Return a scalar, or when group_by (a field name or a list of them) is
+        passed as keyword a list of Dict holding the group fields and func
+
+        Usage:
+            Blog.aggregate('count','*','where user_id=?',uid)
+            Comment.aggregate('count',group_by='blog_id')
+        """
+        if func not in _aggregates:
+            raise ValueError('Unsupported aggregate function %s' % func)
+        col = field == '*' and '*' or '`%s`' % cls._column(field)
+        group_by = kw.pop('group_by',None)
+        if kw:
+            raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+        if not group_by:
+            d = db.select_one('select %s(%s) as `%s` from `%s` %s' % (func,col,func,cls.__table__,where),*args)
+            return d[func]
+        if isinstance(group_by,basestring):
+            group_by = [group_by]
+        groups = ','.join(['`%s`' % cls._column(g) for g in group_by])
+        return db.select_all('select %s,%s(%s) as `%s` from `%s` %s group by %s' %
+                             (groups,func,col,func,cls.__table__,where,groups),*args)
+
+   @classmethod
+   def _column(cls,field):
+        if not field in cls.__mappings__:
+            raise AttributeError('%s has no field %s' % (cls.__name__,field))
+        return cls.__mappings__[field].name
     
    def update(self):
+        """
+        Write the modified updatable fields, no statement is run if there
+        are none
+        """
         self.pre_update and self.pre_update()
+        dirty = self._dirty
         L = []
         args = []
         for k,v in self.__mappings__.iteritems():
-            if v.updatable:
+            if v.updatable and (dirty is None or k in dirty):
                 arg = getattr(self,k)
                 L.append('`%s`=?' % k)
                 args.append(arg)
+        if not L:
+            return self
         pk = self.__primary_key__.name
         args.append(getattr(self,pk))
         db.update('update `%s` set %s where %s=?' % (self.__table__,','.join(L),pk),*args)
+        self._mark_clean()
+        self._identify()
         return self
 
    def delete(self):
@@ -227,6 +775,9 @@ class Model(dict):
         pk = self.__primary_key__.name
         args = (getattr(self,pk),)
         db.update('delete from `%s` where `%s`=?' % (self.__table__,pk),*args)
+        imap = db.get_identity_map()
+        if imap is not None:
+            imap.remove((self.__table__,args[0]))
         return self
 
    def insert(self):
@@ -236,8 +787,101 @@ class Model(dict):
             if v.insertable:
                 params[v.name] = getattr(self,k)
         db.insert('%s' % self.__table__,**params) 
+        self._mark_clean()
+        self._identify()
         return self
 
+   def _identify(self):
+        """
+        Make this object the mapped one for its primary key
+        """
+        imap = db.get_identity_map()
+        if imap is not None:
+            imap.add((self.__table__,getattr(self,self.__primary_key__.name)),self)
+
+   def upsert(self):
+        """
+        Insert, or update the updatable fields when the primary key exists,
+        with a single statement
+        """
+        self.pre_insert and self.pre_insert()
+        pk = self.__primary_key__.name
+        cols = []
+        args = []
+        updates = []
+        for k,v in self.__mappings__.iteritems():
+            if v.insertable or v.primary_key:
+                cols.append('`%s`' % v.name)
+                args.append(getattr(self,k))
+                if v.updatable:
+                    updates.append('`%s`=excluded.`%s`' % (v.name,v.name))
+        sql = 'insert into `%s` (%s) values (%s) on conflict(`%s`) do ' % \
+              (self.__table__,','.join(cols),','.join(['?'] * len(cols)),pk)
+        db.update(sql + (updates and 'update set %s' % ','.join(updates) or 'nothing'),*args)
+        self._mark_clean()
+        self._identify()
+        return self
+
+   def save(self):
+        """
+        Update an object loaded from database, upsert any other one
+        """
+        if self._dirty is None:
+            return self.upsert()
+        return self.update()
+
+   @classmethod
+   def update_where(cls,values,where,*args):
+        """
+        Set values (a dict of updatable fields) on all rows subject to the
+        where clause with one statement and return the row count. Hooks are
+        not called
+        """
+        L = []
+        params = []
+        for k,v in values.iteritems():
+            if not k in cls.__mappings__ or not cls.__mappings__[k].updatable:
+                raise AttributeError('%s has no updatable field %s' % (cls.__name__,k))
+            L.append('`%s`=?' % cls.__mappings__[k].name)
+            params.append(v)
+        r = db.update('update `%s` set %s %s' % (cls.__table__,','.join(L),where),*(params + list(args)))
+        cls._evict()
+        return r
+
+   @classmethod
+   def delete_where(cls,where,*args):
+        """
+        Delete all rows subject to the where clause with one statement and
+        return the row count. Hooks are not called
+        """
+        r = db.update('delete from `%s` %s' % (cls.__table__,where),*args)
+        cls._evict()
+        return r
+
+   @classmethod
+   def _evict(cls):
+        imap = db.get_identity_map()
+        if imap is not None:
+            imap.evict(cls.__table__)
+
+   @classmethod
+   def insert_many(cls,objs,chunk_size=500):
+        """
+        Insert a list of objects in one transaction and return the row count
+        """
+        rows = []
+        for obj in objs:
+            obj.pre_insert and obj.pre_insert()
+            params = {}
+            for k,v in obj.__mappings__.iteritems():
+                if v.insertable:
+                    params[v.name] = getattr(obj,k)
+            rows.append(params)
+        r = db.insert_many(cls.__table__,rows,chunk_size)
+        for obj in objs:
+            obj._mark_clean()
+        return r
+
 def _create_table(table_name,mappings):
     pk = None
     sql = ['--generating SQL for %s:' % table_name,'create table `%s` (' % table_name]
@@ -253,3 +897,37 @@ def _create_table(table_name,mappings):
     sql.append(' primary key(`%s`)' % pk)
     sql.append(');')
     return '\n'.join(sql)
+
+def _select_list(mappings,deferred):
+    """
+    Return the select list leaving out the deferred fields
+    """
+    if not deferred:
+        return '*'
+    fields = sorted([f for k,f in mappings.iteritems() if not k in deferred],
+                    lambda x,y: cmp(x._order,y._order))
+    return ','.join(['`%s`' % f.name for f in fields])
+
+def _create_indexes(table_name,mappings,indexes,unique_indexes):
+    """
+    Return the list of create index statements for fields declared with index
+    or unique and for the composite indexes, which are tuples of field names
+    """
+    specs = []
+    for f in sorted(mappings.values(),lambda x,y: cmp(x._order,y._order)):
+        if f.primary_key:
+            continue
+        if f.unique or f.index:
+            specs.append(((f.name,),f.unique))
+    for unique,L in ((False,indexes),(True,unique_indexes)):
+        for fields in L:
+            for k in fields:
+                if not k in mappings:
+                    raise TypeError('Index on unknown field `%s`' % k)
+            specs.append((tuple([mappings[k].name for k in fields]),unique))
+    sql = []
+    for cols,unique in specs:
+        sql.append('create %sindex if not exists `idx_%s_%s` on `%s` (%s)' %
+                   (unique and 'unique ' or '',table_name,'_'.join(cols),table_name,
+                    ','.join(['`%s`' % c for c in cols])))
+    return sql
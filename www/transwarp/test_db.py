@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import unittest
+import unittest,threading
 import db
 
 class TestDb(unittest.TestCase):
@@ -89,3 +89,348 @@ class TestDb(unittest.TestCase):
         self.assertEquals(len(r12),2)
         
         db.engine = None
+
+    def test_pool(self):
+        db.engine = None
+        db.create_engine('test.db',max_size=2,timeout=0.1,pre_ping=True)
+        #connections are reused instead of reopened
+        with db.connection():
+            db.select_one('select 1')
+            conn = db._db_ctx.connection.connection
+        with db.connection():
+            db.select_one('select 1')
+            self.assertIs(db._db_ctx.connection.connection,conn)
+        stats = db.pool_stats()
+        self.assertEquals(stats.size,1)
+        self.assertEquals(stats.idle,1)
+        self.assertEquals(stats.in_use,0)
+
+        #exhausted pool raises after timeout
+        c1 = db.engine.connect()
+        c2 = db.engine.connect()
+        with self.assertRaises(db.DBError):
+            db.engine.connect()
+        stats = db.pool_stats()
+        self.assertEquals(stats.in_use,2)
+        self.assertEquals(stats.waits,1)
+        self.assertTrue(stats.wait_time > 0)
+        db.engine.release(c1)
+        db.engine.release(c2)
+        db.engine.pool.dispose()
+        self.assertEquals(db.pool_stats().size,0)
+
+        db.engine = None
+
+    def test_insert_many(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        rows = [dict(id=i,name='user%d' % i) for i in range(25)]
+        self.assertEquals(db.insert_many('User',rows,chunk_size=10),25)
+        self.assertEquals(db.insert_many('User',[]),0)
+        self.assertEquals(len(db.select_all('select * from User')),25)
+
+        #the whole batch is rolled back on error
+        with self.assertRaises(Exception):
+            db.insert_many('User',[dict(id=100,name='a'),dict(id=0,name='dup')])
+        self.assertIsNone(db.select_one('select * from User where id=?',100))
+
+        db.engine = None
+
+    def test_select_iter(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.insert_many('User',[dict(id=i,name='user%d' % i) for i in range(25)])
+
+        it = db.select_iter('select * from User where id>=? order by id',5,batch_size=7)
+        rows = list(it)
+        self.assertEquals(len(rows),20)
+        self.assertEquals(rows[0].name,'user5')
+        self.assertEquals(db.pool_stats().in_use,0)
+
+        #connection is held while iterating and returned when stopped early
+        it = db.select_iter('select * from User',batch_size=3)
+        self.assertEquals(next(it).id,0)
+        self.assertEquals(db.pool_stats().in_use,1)
+        it.close()
+        self.assertEquals(db.pool_stats().in_use,0)
+
+        #inside a connection context the context connection is used
+        with db.connection():
+            self.assertEquals(len(list(db.select_iter('select * from User'))),25)
+            self.assertEquals(db.pool_stats().in_use,1)
+            it = db.select_iter('select * from User',batch_size=3)
+            next(it)
+        #and it is kept until the generator stops
+        self.assertEquals(db.pool_stats().in_use,1)
+        self.assertEquals(len(list(it)),24)
+        self.assertEquals(db.pool_stats().in_use,0)
+
+        db.engine = None
+
+    def test_compact_rows(self):
+        db.engine = None
+        db.create_engine('test.db',compact_rows=True)
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.insert_many('User',[dict(id=i,name='user%d' % i) for i in range(3)])
+
+        rows = db.select_all('select id,name from User order by id')
+        self.assertIsInstance(rows[0],db.Row)
+        self.assertEquals(rows[1].name,'user1')
+        self.assertEquals(rows[1]['id'],1)
+        self.assertEquals(rows[1][1],'user1')
+        self.assertEquals(dict(**rows[2]),{'id':2,'name':'user2'})
+        self.assertTrue('name' in rows[0])
+        #the row class is cached per column list
+        self.assertIs(type(rows[0]),type(db.select_one('select id,name from User')))
+        with self.assertRaises(KeyError):
+            rows[0]['empty']
+        with self.assertRaises(AttributeError):
+            rows[0].empty
+        #statements returning no columns give no rows
+        self.assertEquals(db.select_all('pragma user_version=3'),[])
+        self.assertIsNone(db.select_one('pragma user_version=3'))
+        self.assertEquals(list(db.select_iter('pragma user_version=3')),[])
+
+        db.engine = None
+
+    def test_query_cache(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.insert_many('User',[dict(id=i,name='user%d' % i) for i in range(5)])
+        db.enable_query_cache(max_entries=2,ttl=60)
+
+        r1 = db.select_all('select * from User where id<?',3)
+        r2 = db.select_all('select * from User where id<?',3)
+        self.assertEquals(r1,r2)
+        self.assertEquals(db.query_cache_stats().hits,1)
+        self.assertEquals(db.query_cache_stats().misses,1)
+
+        #writes invalidate cached results of the table
+        db.update('update User set name=? where id=?','changed',1)
+        self.assertEquals(db.select_one('select name from User where id=?',1).name,'changed')
+        db.select_one('select name from User where id=?',1)
+        with db.transaction():
+            db.insert('User',id=10,name='user10')
+            #no caching inside transactions
+            self.assertEquals(len(db.select_all('select * from User where id<?',100)),6)
+        self.assertEquals(len(db.select_all('select * from User where id<?',100)),6)
+        stats = db.query_cache_stats()
+        self.assertEquals(stats.hits,2)
+        self.assertEquals(stats.entries,2)
+        self.assertTrue(stats.evictions > 0)
+
+        #expired entries are reloaded
+        db.enable_query_cache(ttl=0)
+        db.select_all('select * from User')
+        db.select_all('select * from User')
+        self.assertEquals(db.query_cache_stats().hits,0)
+        db.disable_query_cache()
+        self.assertIsNone(db.query_cache_stats())
+
+        db.engine = None
+
+    def test_group_commit(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.enable_group_commit(window=0.05,max_batch=8)
+        results = {}
+        def write(i):
+            try:
+                results[i] = db.insert('User',id=i % 15,name='user%d' % i)
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=write,args=(i,)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        #duplicate keys fail alone, the other statements of the batch are committed
+        self.assertEquals(len([r for r in results.values() if r == 1]),15)
+        self.assertEquals(len([r for r in results.values() if isinstance(r,Exception)]),5)
+        self.assertEquals(len(db.select_all('select * from User')),15)
+        self.assertEquals(db.update('update User set name=? where id<?','x',5),5)
+
+        stats = db.group_commit_stats()
+        self.assertEquals(stats.batch_size.count,stats.commit_latency_ms.count)
+        self.assertTrue(stats.batch_size.mean > 1)
+        #writes inside transactions do not go through the writer
+        with db.transaction():
+            db.update('update User set name=? where id=?','y',1)
+        self.assertEquals(db.group_commit_stats().batch_size.count,stats.batch_size.count)
+        db.disable_group_commit()
+        self.assertIsNone(db.group_commit_stats())
+
+        #a connection error fails the batch, a dead writer fails the callers
+        def connect():
+            raise db.DBError('no connection')
+        committer = db._GroupCommitter(db._ConnectionPool(connect))
+        with self.assertRaises(db.DBError):
+            committer.execute('delete from User',())
+        committer._collect = lambda first: 1 / 0
+        with self.assertRaises(db.DBError):
+            committer.execute('delete from User',())
+        with self.assertRaises(db.DBError):
+            committer.execute('delete from User',())
+        committer.stop()
+
+        db.engine = None
+
+    def test_wal_engine(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.select_one('pragma journal_mode=delete')
+        db.engine = None
+        #readers see wal mode before anything is written
+        db.create_engine('test.db',min_size=1,wal=True,pragmas={'cache_size':-1000})
+        self.assertEquals(db.select_one('pragma journal_mode').journal_mode,'wal')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.insert('User',id=1,name='user1')
+
+        with db.connection():
+            self.assertEquals(db.select_one('select name from User where id=?',1).name,'user1')
+            #reads use the read pool, which is read only
+            self.assertIsNone(db._db_ctx.connection.connection)
+            self.assertEquals(db.pool_stats(read=True).in_use,1)
+            with self.assertRaises(Exception):
+                db._db_ctx.connection.read_connection.execute('delete from User')
+
+        #reads inside a transaction see its writes
+        with db.transaction():
+            db.insert('User',id=2,name='user2')
+            self.assertEquals(len(db.select_all('select * from User')),2)
+            self.assertEquals(len(list(db.select_iter('select * from User'))),2)
+            self.assertEquals(db.pool_stats(read=True).in_use,0)
+        self.assertEquals(len(db.select_all('select * from User')),2)
+        self.assertEquals(db.pool_stats().max_size,1)
+
+        #the writer is not held by a connection context between writes
+        db.engine.pool.timeout = 0.5
+        written = threading.Event()
+        done = threading.Event()
+        errors = []
+        def other():
+            written.wait()
+            try:
+                db.insert('User',id=4,name='user4')
+            except Exception, e:
+                errors.append(e)
+            done.set()
+        t = threading.Thread(target=other)
+        t.start()
+        with db.connection():
+            db.insert('User',id=3,name='user3')
+            written.set()
+            done.wait()
+            self.assertEquals(len(db.select_all('select * from User')),4)
+        t.join()
+        self.assertEquals(errors,[])
+
+        db.engine = None
+
+    def test_listeners(self):
+        db.engine = None
+        db.create_engine('test.db')
+        events = []
+        stats = db.QueryStats()
+        slow = db.SlowQueryLog(threshold=0)
+        logged = []
+        slow.logger = type('Logger',(object,),{'warning':lambda self,msg: logged.append(msg)})()
+        for listener in (events.append,stats,slow):
+            db.add_listener(listener)
+        try:
+            db.update('drop table if exists User')
+            db.update('create table User(id int primary key, name varchar(20))')
+            db.insert_many('User',[dict(id=i,name='user%d' % i) for i in range(5)])
+            with db.transaction():
+                db.select_all('select * from User where id<?',3)
+            db.select_one('select * from User where id=1')
+            db.select_one('select * from User where id=2')
+            list(db.select_iter('select * from User'))
+        finally:
+            for listener in (events.append,stats,slow):
+                db.remove_listener(listener)
+        db.select_one('select 1')
+
+        self.assertEquals(len(events),7)
+        select = events[3]
+        self.assertEquals(select.rowcount,3)
+        self.assertEquals(select.args_shape,('int',))
+        self.assertTrue(select.in_transaction)
+        self.assertTrue(select.duration >= 0)
+        self.assertEquals(events[2].rowcount,5)
+        self.assertEquals(events[-1].rowcount,5)
+
+        report = stats.report()
+        by_fp = dict([(d.fingerprint,d) for d in report])
+        d = by_fp['select * from User where id=?']
+        self.assertEquals(d.calls,2)
+        self.assertTrue(d.p50 <= d.p99)
+        self.assertEquals(len(logged),7)
+
+        #a DBError of a listener fails selects but not committed writes
+        def failing(event):
+            raise db.DBError('rejected')
+        db.add_listener(failing)
+        try:
+            self.assertEquals(db.update('update User set name=? where id=?','x',1),1)
+            with self.assertRaises(db.DBError):
+                db.select_one('select * from User where id=?',1)
+        finally:
+            db.remove_listener(failing)
+        self.assertEquals(db.select_one('select name from User where id=?',1).name,'x')
+
+        db.engine = None
+
+    def test_query_plan_auditor(self):
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists User')
+        db.update('create table User(id int primary key, name varchar(20))')
+        db.insert_many('User',[dict(id=i,name='user%d' % i) for i in range(20)])
+        auditor = db.QueryPlanAuditor(min_rows=10)
+        db.add_listener(auditor)
+        try:
+            db.select_one('select * from User where id=?',1)
+            db.select_all('select * from User where name=?','user1')
+            db.select_all('select * from User where name=?','user2')
+            db.select_all('select * from User where id>? order by name',3)
+            auditor.fail = True
+            with self.assertRaises(db.QueryPlanError):
+                db.select_all('select name from User')
+        finally:
+            db.remove_listener(auditor)
+        problems = [i.problem for i in auditor.issues]
+        self.assertEquals(problems.count('full table scan'),2)
+        self.assertTrue('temporary b-tree for order by' in problems)
+        self.assertTrue('select * from User where name=?' in auditor.report())
+        with self.assertRaises(db.QueryPlanError):
+            auditor.check()
+
+        #the plan is explained on the connection already held
+        db.engine = None
+        db.create_engine('test.db',max_size=1,timeout=0.1)
+        db.enable_query_cache()
+        auditor = db.QueryPlanAuditor(min_rows=10,fail=True)
+        db.add_listener(auditor)
+        try:
+            with db.connection():
+                self.assertEquals(len(db.select_all('select * from User where id<?',5)),5)
+            self.assertEquals(db.select_one('select name from User where id=?',1).name,'user1')
+            #writes are reported but not failed, and still invalidate the cache
+            db.update('update User set name=? where name=?','renamed','user1')
+        finally:
+            db.remove_listener(auditor)
+        self.assertEquals(db.select_one('select name from User where id=?',1).name,'renamed')
+        self.assertTrue('update User set name=? where name=?' in auditor.report())
+
+        db.engine = None
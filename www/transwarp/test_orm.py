@@ -81,4 +81,283 @@ class TestOrm(unittest.TestCase):
         result = User.get(user1.id)
         self.assertIsNone(result)
         self.assertEquals(0,User.count_all())
-        
+
+    def test_insert_many(self):
+        users = [User(id=db.get_id(),username='user%d' % i) for i in range(10)]
+        self.assertEquals(User.insert_many(users,chunk_size=3),10)
+        self.assertEquals(User.count_all(),10)
+        self.assertEquals(User.find_one('where username=?','user3').age,10)
+
+    def test_iter(self):
+        User.insert_many([User(id=db.get_id(),username='user%d' % i,age=i) for i in range(10)])
+        self.assertEquals(len(list(User.iter_all(batch_size=3))),10)
+        users = list(User.iter_by('where age>=? order by age',5,batch_size=2))
+        self.assertEquals([u.age for u in users],[5,6,7,8,9])
+        self.assertIsInstance(users[0],User)
+
+    def test_aggregate(self):
+        User.insert_many([User(id=db.get_id(),username='user%d' % (i % 2),age=i) for i in range(10)])
+        self.assertEquals(User.aggregate('sum','age'),45)
+        self.assertEquals(User.aggregate('max','age','where username=?','user0'),8)
+        self.assertEquals(User.aggregate('avg','age'),4.5)
+        self.assertEquals(User.count_by('where age>?',6),3)
+        groups = User.aggregate('count',group_by='username')
+        self.assertEquals(sorted((g.username,g.count) for g in groups),[('user0',5),('user1',5)])
+        with self.assertRaises(ValueError):
+            User.aggregate('median','age')
+        with self.assertRaises(AttributeError):
+            User.aggregate('sum','weight')
+
+    def test_from_row(self):
+        user = User._from_row({'id':'1','username':'row','age':3,'height':1.0,'male':False})
+        self.assertIsInstance(user,User)
+        self.assertEquals(user.username,'row')
+        self.assertEquals(user.age,3)
+        #defaults are not applied to database rows
+        self.assertEquals(User._from_row({'id':'2'}).get('age'),None)
+
+    def test_identity_map(self):
+        user = User(id=db.get_id(),username='mapped')
+        user.insert()
+        self.assertIsNone(db.get_identity_map())
+        with db.connection(identity_map=True):
+            imap = db.get_identity_map()
+            u1 = User.get(user.id)
+            u2 = User.get(user.id)
+            self.assertIs(u1,u2)
+            self.assertIs(User.find_one('where username=?','mapped'),u1)
+            self.assertEquals(imap.stats().hits,1)
+            self.assertEquals(imap.stats().misses,1)
+
+            u3 = User(id=user.id,username='changed')
+            u3.update()
+            self.assertIs(User.get(user.id),u3)
+            u3.delete()
+            self.assertIsNone(User.get(user.id))
+        self.assertIsNone(db.get_identity_map())
+
+        #rolled back objects are dropped from the map
+        ctx = db.transaction(identity_map=True)
+        try:
+            with ctx:
+                User(id='rolled',username='rolled').insert()
+                imap = db.get_identity_map()
+                self.assertEquals(imap.stats().size,1)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(imap.stats().size,0)
+        self.assertIsNone(User.get('rolled'))
+
+    def test_indexes(self):
+        class Post(orm.Model):
+            __indexes__ = (('author','created_at'),)
+            id = orm.StringField(primary_key=True,updatable=False)
+            author = orm.StringField(index=True)
+            slug = orm.StringField(unique=True)
+            created_at = orm.FloatField()
+
+        self.assertEquals(Post.__index_sql__,[
+            'create index if not exists `idx_post_author` on `post` (`author`)',
+            'create unique index if not exists `idx_post_slug` on `post` (`slug`)',
+            'create index if not exists `idx_post_author_created_at` on `post` (`author`,`created_at`)'])
+        db.update('drop table if exists post')
+        db.update(''.join(Post.__sql__.split('\n')[1:]))
+        for sql in Post.__index_sql__:
+            db.update(sql)
+        plan = db.select_one('explain query plan select * from post where author=?','a')
+        self.assertTrue('idx_post_author' in plan.detail)
+
+        with self.assertRaises(TypeError):
+            class Broken(orm.Model):
+                __indexes__ = (('missing',),)
+                id = orm.StringField(primary_key=True,updatable=False)
+
+    def test_dirty_fields(self):
+        user = User(id=db.get_id(),username='dirty')
+        #objects not loaded from database write every field
+        self.assertEquals(user.dirty_fields(),frozenset(User.__mappings__))
+        user.insert()
+        self.assertEquals(user.dirty_fields(),frozenset())
+
+        loaded = User.get(user.id)
+        self.assertEquals(loaded.dirty_fields(),frozenset())
+        loaded.username = 'dirty'
+        self.assertEquals(loaded.dirty_fields(),frozenset())
+        loaded.age = 30
+        loaded['height'] = 1.8
+        self.assertEquals(loaded.dirty_fields(),frozenset(['age','height']))
+
+        #only modified columns are written
+        db.update('update user set username=? where id=?','other',user.id)
+        loaded.update()
+        self.assertEquals(loaded.dirty_fields(),frozenset())
+        reloaded = User.get(user.id)
+        self.assertEquals(reloaded.username,'other')
+        self.assertEquals(reloaded.age,30)
+        self.assertEquals(reloaded.height,1.8)
+
+    def test_get_many(self):
+        users = [User(id='u%d' % i,username='user%d' % i) for i in range(7)]
+        User.insert_many(users)
+        d = User.get_many(['u1','u3','u3','missing'],chunk_size=2)
+        self.assertEquals(sorted(d.keys()),['u1','u3'])
+        self.assertEquals(d['u3'].username,'user3')
+        L = User.get_many(['u5','missing','u0','u5'],ordered=True)
+        self.assertEquals([u and u.id for u in L],['u5',None,'u0','u5'])
+        self.assertIs(L[0],L[3])
+        self.assertEquals(User.get_many([]),{})
+
+    def test_prefetch(self):
+        class Article(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            user_id = orm.StringField()
+            user = orm.BelongsTo('User','user_id')
+            notes = orm.HasMany('Note','article_id','order by id')
+
+        class Note(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            article_id = orm.IntegerField()
+            article = orm.BelongsTo(Article,'article_id')
+
+        for m in (Article,Note):
+            db.update('drop table if exists %s' % m.__table__)
+            db.update(''.join(m.__sql__.split('\n')[1:]))
+        User.insert_many([User(id='a'),User(id='b')])
+        Article.insert_many([Article(id=i,user_id='ab'[i % 2]) for i in range(4)])
+        Note.insert_many([Note(id=i,article_id=i % 3) for i in range(6)])
+
+        #lazy loading
+        article = Article.get(1)
+        self.assertEquals(article.user.id,'b')
+        self.assertEquals([n.id for n in article.notes],[1,4])
+        #models of the same name in other modules do not shadow each other
+        Other = orm.ModelMetaclass('User',(orm.Model,),dict(__module__='other',__table__='other_user',
+                                   id=orm.StringField(primary_key=True,updatable=False)))
+        class Reply(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            user = orm.BelongsTo('User','user_id')
+        self.assertIs(Reply.user.model,User)
+        self.assertIs(orm.BelongsTo('other.User','user_id').model,Other)
+
+        articles = Article.find_by('order by id',prefetch=('user','notes.article'))
+        self.assertEquals([a.user.id for a in articles],['a','b','a','b'])
+        self.assertIs(articles[0].user,articles[2].user)
+        self.assertEquals([n.id for n in articles[0].notes],[0,3])
+        self.assertEquals(articles[3].notes,[])
+        self.assertEquals(articles[2].notes[0].article.id,2)
+        self.assertEquals(len(Article.find_all(prefetch=('notes',))),4)
+        with self.assertRaises(AttributeError):
+            Article.find_all(prefetch=('missing',))
+
+    def test_query(self):
+        User.insert_many([User(id='u%02d' % i,username='user%d' % (i % 3),age=i % 4) for i in range(12)])
+        q = User.query().where('username=?','user1')
+        self.assertEquals(q.count(),4)
+        self.assertEquals([u.id for u in q.order_by('-id').limit(2).all()],['u10','u07'])
+        self.assertEquals([u.id for u in q.order_by('id').limit(2).offset(1).all()],['u04','u07'])
+        self.assertEquals(q.order_by('id').first().id,'u01')
+        self.assertEquals(len(list(q.where('age>?',1))),2)
+        #the base query is not changed by chaining
+        self.assertEquals(q.count(),4)
+        self.assertIs(q._compile('*'),User.query().where('username=?','user2')._compile('*'))
+
+        #keyset pagination, uniform and mixed directions
+        for order in (('-age','-id'),('age','-id'),('age',)):
+            expected = [u.id for u in User.query().order_by(*order).all()]
+            if len(order) == 1:
+                expected = [u.id for u in User.query().order_by('age','id').all()]
+            ids = []
+            cursor = None
+            while True:
+                L,cursor = User.query().order_by(*order).page(5,cursor)
+                ids.extend([u.id for u in L])
+                if cursor is None:
+                    break
+            self.assertEquals(ids,expected)
+        with self.assertRaises(ValueError):
+            User.query().page(5,'garbage')
+        #values inlined in where clauses do not grow the compiled cache forever
+        for i in range(5000):
+            User.query().where("name='%d'" % i)._compile('*')
+        self.assertTrue(len(orm._compiled) <= 4097)
+
+    def test_deferred(self):
+        class Page(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            title = orm.StringField()
+            body = orm.TextField(deferred=True)
+
+        db.update('drop table if exists page')
+        db.update(''.join(Page.__sql__.split('\n')[1:]))
+        Page.insert_many([Page(id=i,title='t%d' % i,body='b%d' % i) for i in range(5)])
+
+        page = Page.get(1)
+        self.assertFalse('body' in page)
+        self.assertEquals(page.body,'b1')
+        self.assertEquals(page['body'],'b1')
+
+        pages = Page.find_all()
+        self.assertTrue(all([not 'body' in p for p in pages]))
+        Page.undefer(pages)
+        self.assertEquals([p.body for p in pages],['b%d' % i for i in range(5)])
+        self.assertTrue(all([not p._deferred for p in pages]))
+
+        pages = Page.query().only('body').order_by('id').all()
+        self.assertFalse('title' in pages[0])
+        self.assertEquals(pages[0].body,'b0')
+        self.assertEquals(pages[0].title,'t0')
+        page = Page.query().defer('title').where('id=?',2).first()
+        self.assertFalse('title' in page or 'body' in page)
+        L,cursor = Page.query().only('body').order_by('title').page(2)
+        self.assertEquals([p.id for p in L],[0,1])
+
+        #modified deferred fields are written without loading them
+        page = Page.get(3)
+        page.body = 'changed'
+        page.update()
+        self.assertEquals(Page.get(3).body,'changed')
+        with self.assertRaises(AttributeError):
+            page.missing
+
+        #defaults of a custom constructor do not hide deferred fields
+        class Doc(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            body = orm.TextField(deferred=True)
+            def __init__(self,**kw):
+                super(Doc,self).__init__(**kw)
+        db.update('drop table if exists doc')
+        db.update(''.join(Doc.__sql__.split('\n')[1:]))
+        Doc(id=1,body='real body').insert()
+        self.assertEquals(Doc.get(1).body,'real body')
+        self.assertEquals([d.body for d in Doc.iter_all()],['real body'])
+        self.assertEquals([d.body for d in Doc.iter_by('where id=?',1)],['real body'])
+        self.assertEquals([d.body for d in Doc.query()],['real body'])
+
+    def test_set_operations(self):
+        User.insert_many([User(id='u%d' % i,username='user%d' % (i % 2),age=i) for i in range(6)])
+        self.assertEquals(User.update_where({'username':'renamed'},'where username=?','user1'),3)
+        self.assertEquals(User.count_by('where username=?','renamed'),3)
+        self.assertEquals(User.delete_where('where age>?',3),2)
+        self.assertEquals(User.count_all(),4)
+        with self.assertRaises(AttributeError):
+            User.update_where({'id':'x'},'')
+
+        #upsert inserts then updates
+        User(id='new',username='first',age=1).upsert()
+        User(id='new',username='second',age=2).upsert()
+        self.assertEquals(User.get('new').username,'second')
+        self.assertEquals(User.count_all(),5)
+
+        #save updates loaded objects and upserts new ones
+        user = User.get('u0')
+        user.age = 50
+        user.save()
+        self.assertEquals(User.get('u0').age,50)
+        User(id='saved',username='saved').save()
+        self.assertEquals(User.get('saved').username,'saved')
+
+        with db.connection(identity_map=True):
+            user = User.get('u0')
+            User.update_where({'age':60},'where id=?','u0')
+            self.assertEquals(User.get('u0').age,60)
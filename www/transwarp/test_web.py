@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import unittest,os,shutil,tempfile,gzip,threading,web,db,orm
+from cStringIO import StringIO
+
+def route(method,path):
+    def _handler(*args):
+        return (path,) + args
+    _handler.__web_route__ = path
+    _handler.__web_method__ = method
+    return web.Route(_handler)
+
+class TestWeb(unittest.TestCase):
+    def test_router(self):
+        router = web.Router()
+        routes = [route('GET','/'),
+                  route('GET','/blog/list'),
+                  route('GET','/blog/:id'),
+                  route('POST','/blog/:id'),
+                  route('GET','/blog/:id/comments'),
+                  route('GET','/user/:uid/blog/:bid'),
+                  route('GET','/file/:name-:ext'),
+                  route('GET','/file/readme')]
+        for r in routes:
+            router.add(r)
+        router.add(web.StaticFileRoute())
+
+        self.assertEquals(router.match('GET','/'),(routes[0],()))
+        self.assertEquals(router.match('GET','/blog/list'),(routes[1],()))
+        self.assertEquals(router.match('GET','/blog/123'),(routes[2],('123',)))
+        self.assertEquals(router.match('POST','/blog/123'),(routes[3],('123',)))
+        self.assertEquals(router.match('GET','/blog/123/comments'),(routes[4],('123',)))
+        self.assertEquals(router.match('GET','/user/u1/blog/b2'),(routes[5],('u1','b2')))
+        self.assertEquals(router.match('GET','/file/a-b'),(routes[6],('a','b')))
+        self.assertEquals(router.match('GET','/file/readme'),(routes[7],()))
+        self.assertIsNone(router.match('GET','/blog/'))
+        self.assertIsNone(router.match('GET','/blog/1/2'))
+        self.assertIsNone(router.match('DELETE','/blog/1'))
+        r,args = router.match('GET','/static/css/site.css')
+        self.assertIsInstance(r,web.StaticFileRoute)
+        self.assertEquals(args,('static/css/site.css',))
+
+        #the trie agrees with the regex of every route
+        for path in ('/blog/abc','/user/x/blog/y','/file/x.y-z'):
+            r,args = router.match('GET',path)
+            self.assertEquals(r.match(path),args)
+
+    def test_static_files(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root,'static'))
+            with open(os.path.join(root,'static','site.css'),'w') as f:
+                f.write('body{}' * 10)
+            with open(os.path.join(root,'static','big.bin'),'wb') as f:
+                f.write('x' * 100)
+            route = web.StaticFileRoute(root,max_cached_size=64)
+            path = route.match('/static/site.css')[0]
+
+            status,headers,body = route.serve({},path)
+            headers = dict(headers)
+            self.assertEquals(status,'200 OK')
+            self.assertEquals(''.join(body),'body{}' * 10)
+            self.assertEquals(headers['Content-Type'],'text/css')
+            self.assertEquals(headers['Content-Length'],'60')
+
+            #conditional requests
+            status,h,body = route.serve({'HTTP_IF_NONE_MATCH':headers['ETag']},path)
+            self.assertEquals(status,'304 Not Modified')
+            self.assertEquals(list(body),[])
+            status,h,body = route.serve({'HTTP_IF_MODIFIED_SINCE':headers['Last-Modified']},path)
+            self.assertEquals(status,'304 Not Modified')
+            status,h,body = route.serve({'HTTP_IF_NONE_MATCH':'"other"'},path)
+            self.assertEquals(status,'200 OK')
+
+            #ranges, from memory and from disk
+            status,h,body = route.serve({'HTTP_RANGE':'bytes=0-3'},path)
+            self.assertEquals(status,'206 Partial Content')
+            self.assertEquals(''.join(body),'body')
+            self.assertEquals(dict(h)['Content-Range'],'bytes 0-3/60')
+            status,h,body = route.serve({'HTTP_RANGE':'bytes=-10'},'static/big.bin')
+            self.assertEquals(''.join(body),'x' * 10)
+            status,h,body = route.serve({'HTTP_RANGE':'bytes=500-'},path)
+            self.assertEquals(status,'416 Request Range Not Satisfiable')
+
+            #large files go through the server file wrapper
+            wrapped = []
+            def file_wrapper(f,size):
+                wrapped.append(f)
+                return iter(lambda: f.read(size),'')
+            status,h,body = route.serve({'wsgi.file_wrapper':file_wrapper},'static/big.bin')
+            self.assertEquals(''.join(body),'x' * 100)
+            self.assertEquals(len(wrapped),1)
+
+            #the memory cache follows file changes
+            with open(os.path.join(root,'static','site.css'),'w') as f:
+                f.write('changed')
+            os.utime(os.path.join(root,'static','site.css'),(1,1))
+            status,h,body = route.serve({},path)
+            self.assertEquals(''.join(body),'changed')
+
+            with self.assertRaises(web.HttpError):
+                route.serve({},'static/missing.css')
+            with self.assertRaises(web.HttpError):
+                route.serve({},'static/../../etc/passwd')
+        finally:
+            shutil.rmtree(root)
+
+    def test_compression(self):
+        gz = {'HTTP_ACCEPT_ENCODING':'gzip, deflate'}
+        text = 'hello world ' * 200
+        headers = [('Content-Type','text/html; charset=utf-8'),('Content-Length',str(len(text)))]
+        status,h,body = web.compress(gz,'200 OK',headers,[text])
+        h = dict(h)
+        self.assertEquals(h['Content-Encoding'],'gzip')
+        self.assertEquals(h['Vary'],'Accept-Encoding')
+        self.assertEquals(int(h['Content-Length']),len(body[0]))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(body[0])).read(),text)
+
+        #streamed bodies are compressed chunk by chunk
+        status,h,body = web.compress(gz,'200 OK',headers,iter([text,text]))
+        self.assertFalse('Content-Length' in dict(h))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(''.join(body))).read(),text * 2)
+
+        #small, binary or unaccepted responses are left alone
+        self.assertEquals(web.compress(gz,'200 OK',headers,['small'])[2],['small'])
+        self.assertEquals(web.compress(gz,'200 OK',[('Content-Type','image/png')],[text])[2],[text])
+        status,h,body = web.compress({},'200 OK',headers,[text])
+        self.assertEquals(body,[text])
+        self.assertEquals(dict(h)['Vary'],'Accept-Encoding')
+
+    def test_static_gzip(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root,'static'))
+            fpath = os.path.join(root,'static','app.js')
+            with open(fpath,'w') as f:
+                f.write('var a = 1;\n' * 500)
+            route = web.StaticFileRoute(root,gzip_min_size=100)
+            gz = {'HTTP_ACCEPT_ENCODING':'gzip'}
+            status,h,body = route.serve(gz,'static/app.js')
+            h = dict(h)
+            self.assertEquals(h['Content-Encoding'],'gzip')
+            self.assertTrue(h['ETag'].endswith('-gzip"'))
+            self.assertEquals(gzip.GzipFile(fileobj=StringIO(''.join(body))).read(),'var a = 1;\n' * 500)
+            self.assertTrue(os.path.exists(fpath + '.gz'))
+            status,h2,body = route.serve(dict(gz,HTTP_IF_NONE_MATCH=h['ETag']),'static/app.js')
+            self.assertEquals(status,'304 Not Modified')
+
+            #the sibling is rebuilt when the file changes
+            with open(fpath,'w') as f:
+                f.write('var b = 2;\n' * 500)
+            os.utime(fpath,(1,1))
+            status,h,body = route.serve(gz,'static/app.js')
+            self.assertEquals(gzip.GzipFile(fileobj=StringIO(''.join(body))).read(),'var b = 2;\n' * 500)
+
+            #ranges and clients without gzip get the plain file
+            status,h,body = route.serve(dict(gz,HTTP_RANGE='bytes=0-2'),'static/app.js')
+            self.assertEquals(''.join(body),'var')
+            status,h,body = route.serve({},'static/app.js')
+            self.assertFalse('Content-Encoding' in dict(h))
+        finally:
+            shutil.rmtree(root)
+
+    def test_conditional_get(self):
+        calls = []
+        versions = {'1':1}
+
+        @web.validator(lambda id: versions[id])
+        def blog(id):
+            calls.append(id)
+            return 'blog %s' % id
+        blog.__web_route__ = '/blog/:id'
+        blog.__web_method__ = 'GET'
+        r = web.Route(blog)
+
+        status,headers,body = r.handle({},'1')
+        self.assertEquals(status,'200 OK')
+        self.assertEquals(body,['blog 1'])
+        etag = dict(headers)['ETag']
+        #a matching validator skips the handler
+        status,headers,body = r.handle({'HTTP_IF_NONE_MATCH':etag},'1')
+        self.assertEquals(status,'304 Not Modified')
+        self.assertEquals(len(calls),1)
+        versions['1'] = 2
+        status,headers,body = r.handle({'HTTP_IF_NONE_MATCH':etag},'1')
+        self.assertEquals(status,'200 OK')
+        self.assertEquals(len(calls),2)
+
+        #without a validator the body hash is used
+        h = route('GET','/page')
+        status,headers,body = h.handle({})
+        etag = dict(headers)['ETag']
+        status,headers,body = h.handle({'HTTP_IF_NONE_MATCH':etag})
+        self.assertEquals(status,'304 Not Modified')
+        self.assertEquals(body,[])
+        #non GET routes are not conditional
+        status,headers,body = route('POST','/page').handle({'HTTP_IF_NONE_MATCH':'*'})
+        self.assertEquals(status,'200 OK')
+        self.assertEquals(headers,[])
+
+    def test_response_cache(self):
+        cache = web.ResponseCache(max_entries=2)
+        renders = []
+        def render(value):
+            renders.append(value)
+            return '"%s"' % value,[value]
+        self.assertEquals(cache.fetch('a',lambda: render('a1'),60),('"a1"',['a1']))
+        self.assertEquals(cache.fetch('a',lambda: render('a2'),60),('"a1"',['a1']))
+        cache.fetch('b',lambda: render('b'),60)
+        cache.fetch('c',lambda: render('c'),60)
+        #a was the least recently used entry
+        self.assertEquals(cache.fetch('a',lambda: render('a3'),60)[1],['a3'])
+
+        #one thread renders an expired entry while the others get it stale
+        started = threading.Event()
+        release = threading.Event()
+        def slow():
+            started.set()
+            release.wait()
+            return render('s2')
+        cache.fetch('s',lambda: render('s1'),0,60)
+        t = threading.Thread(target=lambda: cache.fetch('s',slow,0,60))
+        t.start()
+        started.wait()
+        self.assertEquals(cache.fetch('s',lambda: render('s3'),0,60)[1],['s1'])
+        release.set()
+        t.join()
+        self.assertFalse('s3' in renders)
+        self.assertEquals(cache.stats()['stale_hits'],1)
+
+        #writes to a table drop the entries depending on it
+        cache.fetch('t',lambda: render('t1'),60,0,('blogs',))
+        cache.invalidate(('users',))
+        self.assertEquals(cache.fetch('t',lambda: render('t2'),60,0,('blogs',))[1],['t1'])
+        cache.invalidate(('blogs',))
+        self.assertEquals(cache.fetch('t',lambda: render('t3'),60,0,('blogs',))[1],['t3'])
+
+    def test_cached_route(self):
+        class Note(orm.Model):
+            id = orm.IntegerField(primary_key=True,updatable=False)
+            text = orm.StringField()
+        db.engine = None
+        db.create_engine('test.db')
+        db.update('drop table if exists note')
+        db.update(Note.__sql__)
+        Note(id=1,text='first').insert()
+
+        calls = []
+        @web.cached(ttl=60,tables=(Note,),cookies=('lang',))
+        def note(id):
+            calls.append(id)
+            return Note.get(int(id)).text
+        note.__web_route__ = '/note/:id'
+        note.__web_method__ = 'GET'
+        r = web.Route(note)
+
+        status,headers,body = r.handle({'PATH_INFO':'/note/1'},'1')
+        self.assertEquals(body,['first'])
+        self.assertEquals(dict(headers)['Vary'],'Cookie')
+        etag = dict(headers)['ETag']
+        status,headers,body = r.handle({'PATH_INFO':'/note/1','HTTP_IF_NONE_MATCH':etag},'1')
+        self.assertEquals(status,'304 Not Modified')
+        self.assertEquals(len(calls),1)
+        #another cookie value is another entry
+        r.handle({'PATH_INFO':'/note/1','HTTP_COOKIE':'lang=fr; x=1'},'1')
+        self.assertEquals(len(calls),2)
+        r.handle({'PATH_INFO':'/note/1','HTTP_COOKIE':'lang=%ff'},'1')
+        self.assertEquals(len(calls),3)
+
+        note = Note.get(1)
+        note.text = 'second'
+        note.update()
+        status,headers,body = r.handle({'PATH_INFO':'/note/1'},'1')
+        self.assertEquals(body,['second'])
+        self.assertEquals(len(calls),4)
+
+        #writes also drop the entries of a cache of its own
+        cache = web.ResponseCache()
+        @web.cached(ttl=60,tables=('note',),cache=cache)
+        def text(id):
+            return Note.get(int(id)).text
+        text.__web_route__ = '/text/:id'
+        text.__web_method__ = 'GET'
+        r = web.Route(text)
+        self.assertEquals(r.handle({},'1')[2],['second'])
+        Note.update_where({'text':'third'},'where id=?',1)
+        self.assertEquals(r.handle({},'1')[2],['third'])
+        db.remove_write_listener(cache.invalidate)
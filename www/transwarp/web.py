@@ -6,7 +6,9 @@ A simple, lightweight, WSGI-compatible web framework
 
 """
 import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging
-import urllib,traceback
+import urllib,traceback,zlib,gzip,hashlib
+from email.utils import formatdate,parsedate_tz,mktime_tz
+import db
 
 try:
     from cStringIO import StringIO
@@ -192,7 +194,7 @@ class HttpError(Exception):
 
     def __unicode__(self):
         return self.status
-    __repr__ == __unicode__
+    __repr__ = __unicode__
 
 class RedirectError(HttpError):
     def __init__(self,code,location):
@@ -286,6 +288,73 @@ def _build_regex(path):
     re_list.append('$')
     return ''.join(re_list)
 
+def validator(fn):
+    """
+    Declare a cheap validator of a route handler. fn is called with the
+    handler arguments and returns a value changing whenever the response
+    does, like a version counter or a max(created_at). Route.handle answers
+    a matching If-None-Match with 304 without running the handler
+
+    Usage:
+        @validator(lambda id: Blog.aggregate('max','created_at','where id=?',id))
+        def blog(id):
+            pass
+    """
+    def _decorator(func):
+        func.__web_validator__ = fn
+        return func
+    return _decorator
+
+def cached(ttl=60,stale=0,tables=(),vary=(),cookies=(),cache=None):
+    """
+    Cache the responses of a GET route handler for ttl seconds, keyed by the
+    request path and query string, the route arguments and the values of the
+    vary request headers and of the cookies. An expired response is served
+    for stale more seconds while a single request renders it again. Writes
+    to tables (names or Model classes) drop the cached responses, of
+    response_cache or of the given cache
+
+    Usage:
+        @cached(ttl=30,stale=300,tables=(Blog,Comment),cookies=('awesession',))
+        def blog(id):
+            pass
+        blog.__web_route__ = '/blog/:id'
+        blog.__web_method__ = 'GET'
+    """
+    if cache is not None:
+        db.add_write_listener(cache.invalidate)
+    def _decorator(func):
+        func.__web_cache__ = dict(ttl=ttl,stale=stale,vary=tuple(vary),cookies=tuple(cookies),
+                                  tables=tuple([getattr(t,'__table__',t).lower() for t in tables]),
+                                  cache=cache)
+        return func
+    return _decorator
+
+def _normalize_etag(etag):
+    #weak and gzip variants of a response validate the same resource
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    if etag.endswith('-gzip"'):
+        etag = etag[:-6] + '"'
+    return etag
+
+def _etag_matches(header,etag):
+    """
+    Return True if the If-None-Match header matches etag
+
+    >>> _etag_matches('"a", W/"b"','"b"')
+    True
+    >>> _etag_matches('"a-gzip"','W/"a"')
+    True
+    >>> _etag_matches('"a"','"b"')
+    False
+    """
+    if header.strip() == '*':
+        return True
+    etag = _normalize_etag(etag)
+    return etag in [_normalize_etag(t) for t in header.split(',')]
+
 class Route(object):
     """
     A Route object is callable
@@ -298,6 +367,8 @@ class Route(object):
         if not self.is_static:
             self.route = re.compile(_build_regex(self.path))
         self.func = func
+        self.validator = getattr(func,'__web_validator__',None)
+        self.cache = getattr(func,'__web_cache__',None)
 
     def match(self,url):
         m = self.route.match(url)
@@ -308,6 +379,50 @@ class Route(object):
     def __call__(self,*args):
         return self.func(*args)
 
+    def handle(self,environ,*args):
+        """
+        Run the handler as a conditional GET and return (status,headers,body).
+        With a validator the ETag is derived from it and checked before the
+        handler runs, otherwise from a hash of a body made of strings
+
+        """
+        conditional = self.method == 'GET' and environ.get('REQUEST_METHOD','GET') in ('GET','HEAD')
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        etag = None
+        if conditional and self.validator is not None:
+            version = self.validator(*args)
+            etag = 'W/"%s"' % hashlib.sha1(repr((self.path,args,version))).hexdigest()[:20]
+            if if_none_match and _etag_matches(if_none_match,etag):
+                return _status(304),[('ETag',etag)],[]
+        headers = []
+        if conditional and self.cache is not None:
+            options = self.cache
+            cache = options['cache'] or response_cache
+            key = cache.key(environ,self.method,self.path,args,options['vary'],options['cookies'])
+            body_etag,body = cache.fetch(key,lambda: self._render(args),options['ttl'],
+                                         options['stale'],options['tables'])
+            for name in options['vary'] + (options['cookies'] and ('Cookie',) or ()):
+                _add_vary(headers,name)
+            etag = etag or body_etag
+        else:
+            body = self.func(*args)
+            if isinstance(body,basestring):
+                body = [body]
+        if conditional and etag is None and isinstance(body,(list,tuple)):
+            etag = _body_etag(body)
+        if conditional and etag is not None and if_none_match and _etag_matches(if_none_match,etag):
+            return _status(304),headers + [('ETag',etag)],[]
+        if etag:
+            headers.append(('ETag',etag))
+        return _status(200),headers,body
+
+    def _render(self,args):
+        body = self.func(*args)
+        if isinstance(body,basestring):
+            body = [body]
+        body = list(body)
+        return _body_etag(body),body
+
     def __unicode__(self):
         if self.is_static:
             return 'Route Static %s , path = %s' % (self.method,self.path)
@@ -315,25 +430,560 @@ class Route(object):
 
     __repr__ = __unicode__
 
-def _static_file_generator(fpath):
+def _body_etag(body):
+    md5 = hashlib.md5()
+    for chunk in body:
+        md5.update(_to_strs(chunk))
+    return '"%s"' % md5.hexdigest()
+
+def _parse_cookies(header):
+    cookies = {}
+    for item in header.split(';'):
+        name,sep,value = item.partition('=')
+        if sep:
+            #raw values, they only tell cached responses apart
+            cookies[name.strip()] = value.strip()
+    return cookies
+
+class _Flight(object):
+    #a response being rendered, waited on by concurrent requests for it
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+class ResponseCache(object):
+    """
+    LRU cache of rendered responses with ttl and size limits. An expired
+    entry is served for stale more seconds while the one request which
+    found it expired renders it again, requests for a missing entry wait for
+    the one rendering it. Entries are checked against db.TableVersions
+
+    """
+    def __init__(self,max_entries=1000,max_bytes=16 * 1024 * 1024):
+        self._entries = db.LRUCache(max_entries,max_bytes)
+        self._versions = db.TableVersions()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.invalidations = 0
+
+    def key(self,environ,method,path,args,vary=(),cookies=()):
+        key = [method,path,args,environ.get('PATH_INFO',''),environ.get('QUERY_STRING','')]
+        for name in vary:
+            key.append(environ.get('HTTP_' + name.upper().replace('-','_')))
+        if cookies:
+            values = _parse_cookies(environ.get('HTTP_COOKIE',''))
+            key.extend([values.get(name) for name in cookies])
+        return tuple(key)
+
+    def fetch(self,key,render,ttl,stale=0,tables=()):
+        """
+        Return the (etag,body) cached under key, call render() to make it
+        when it is missing or expired
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value,snapshot,expires = entry
+                if snapshot != self._versions.snapshot(tables):
+                    self.invalidations = self.invalidations + 1
+                    self._entries.pop(key)
+                else:
+                    now = time.time()
+                    if now < expires:
+                        self.hits = self.hits + 1
+                        return value
+                    if now < expires + stale and key in self._flights:
+                        self.stale_hits = self.stale_hits + 1
+                        return value
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                snapshot = self._versions.snapshot(tables)
+                self.misses = self.misses + 1
+            else:
+                self.waits = self.waits + 1
+                snapshot = None
+        if snapshot is None:
+            flight.event.wait()
+            if flight.value is not None:
+                return flight.value
+            #rendering failed, fail on our own
+            return render()
+        try:
+            flight.value = render()
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.value is not None:
+                    self._put(key,flight.value,tables,snapshot,ttl)
+            flight.event.set()
+        return flight.value
+
+    def _put(self,key,value,tables,snapshot,ttl):
+        #a write happened while the response was rendered
+        if snapshot != self._versions.snapshot(tables):
+            return
+        size = sum([len(_to_strs(chunk)) for chunk in value[1]])
+        self._entries.put(key,(value,snapshot,time.time() + ttl),size)
+
+    def invalidate(self,tables=None):
+        """
+        Bump the versions of tables, or drop everything if tables is None
+
+        """
+        with self._lock:
+            self._versions.bump(tables)
+            if tables is None:
+                self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return dict(hits=self.hits,stale_hits=self.stale_hits,misses=self.misses,
+                        waits=self.waits,
+                        hit_ratio=total and float(self.hits + self.stale_hits) / total or 0.0,
+                        evictions=self._entries.evictions,invalidations=self.invalidations,
+                        entries=len(self._entries),bytes=self._entries.bytes)
+
+#the cache of @cached routes, emptied of the tables written through transwarp.db
+response_cache = ResponseCache()
+db.add_write_listener(response_cache.invalidate)
+
+def _static_file_generator(fpath,start=0,length=None):
     BLOCK_SIZE = 8192
     with open(fpath,'rb') as f:
-        block = f.read(BLOCK_SIZE)
-        while block:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            n = BLOCK_SIZE if remaining is None else min(BLOCK_SIZE,remaining)
+            block = f.read(n)
+            if not block:
+                break
+            if remaining is not None:
+                remaining = remaining - len(block)
             yield block
-            block = f.read(BLOCK_SIZE)
+
+def _status(code):
+    return '%d %s' % (code,_RESPONSE_STATUSES[code])
+
+def _parse_range(header,size):
+    """
+    Parse a single byte range header, return (start,end) inclusive, None if
+    the header should be ignored or False if it is not satisfiable
+
+    >>> _parse_range('bytes=0-99',1000)
+    (0, 99)
+    >>> _parse_range('bytes=-100',1000)
+    (900, 999)
+    >>> _parse_range('bytes=990-',1000)
+    (990, 999)
+    >>> _parse_range('bytes=1000-',1000)
+    False
+    >>> _parse_range('bytes=0-0',1000)
+    (0, 0)
+    >>> _parse_range('bytes=5-0',1000)
+    >>> _parse_range('bytes=0-1,5-6',1000)
+    """
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first,sep,last = header[6:].strip().partition('-')
+    try:
+        if not first:
+            n = int(last)
+            if n <= 0:
+                return False
+            return max(size - n,0),size - 1
+        start = int(first)
+        if last:
+            end = int(last)
+            #an invalid range is ignored
+            if end < start:
+                return None
+        else:
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    return start,min(end,size - 1)
+
+#content types worth compressing
+_RE_COMPRESSIBLE = re.compile(r'^(text/|application/(json|javascript|x-javascript|xml|xhtml\+xml|rss\+xml|atom\+xml)|image/svg\+xml)')
+
+def _accepts_gzip(environ):
+    """
+    Return True if the Accept-Encoding header allows gzip
+
+    >>> _accepts_gzip({'HTTP_ACCEPT_ENCODING':'deflate, gzip;q=0.5'})
+    True
+    >>> _accepts_gzip({'HTTP_ACCEPT_ENCODING':'gzip;q=0, *'})
+    False
+    >>> _accepts_gzip({'HTTP_ACCEPT_ENCODING':'*;q=1'})
+    True
+    """
+    q = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING','').split(','):
+        coding,sep,params = item.strip().lower().partition(';')
+        value = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                value = float(params[2:])
+            except ValueError:
+                value = 0.0
+        q[coding.strip()] = value
+    if 'gzip' in q:
+        return q['gzip'] > 0
+    return q.get('*',0) > 0
+
+def _gzip(data):
+    buf = StringIO()
+    #a fixed mtime keeps the output, and so the ETag, stable
+    f = gzip.GzipFile(fileobj=buf,mode='wb',compresslevel=6,mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+def _gzip_stream(body):
+    z = zlib.compressobj(6,zlib.DEFLATED,16 + zlib.MAX_WBITS)
+    try:
+        for chunk in body:
+            data = z.compress(_to_strs(chunk))
+            if data:
+                yield data
+        yield z.flush()
+    finally:
+        if hasattr(body,'close'):
+            body.close()
+
+def _header(headers,name):
+    name = name.upper()
+    for k,v in headers:
+        if k.upper() == name:
+            return v
+    return None
+
+def _add_vary(headers,value='Accept-Encoding'):
+    for i,(k,v) in enumerate(headers):
+        if k.upper() == 'VARY':
+            if not value.upper() in [x.strip().upper() for x in v.split(',')]:
+                headers[i] = (k,'%s, %s' % (v,value))
+            return
+    headers.append(('Vary',value))
+
+def compress(environ,status,headers,body,min_size=1024):
+    """
+    Gzip a response of a compressible content type when the client accepts
+    it. A body of strings is compressed at once if it holds at least min_size
+    bytes, any other iterable is compressed while it is streamed. Return
+    (status,headers,body)
+
+    """
+    ctype = _header(headers,'Content-Type')
+    if not ctype or not _RE_COMPRESSIBLE.match(ctype) or not status.startswith('200'):
+        return status,headers,body
+    if _header(headers,'Content-Encoding'):
+        return status,headers,body
+    headers = list(headers)
+    _add_vary(headers)
+    if not _accepts_gzip(environ):
+        return status,headers,body
+    if isinstance(body,basestring):
+        body = [body]
+    if isinstance(body,(list,tuple)):
+        data = ''.join([_to_strs(x) for x in body])
+        if len(data) < min_size:
+            return status,headers,[data]
+        data = _gzip(data)
+        headers = [(k,v) for k,v in headers if k.upper() != 'CONTENT-LENGTH']
+        headers.append(('Content-Length',str(len(data))))
+        body = [data]
+    else:
+        headers = [(k,v) for k,v in headers if k.upper() != 'CONTENT-LENGTH']
+        body = _gzip_stream(body)
+    etag = _header(headers,'ETag')
+    if etag:
+        headers = [(k,v) for k,v in headers if k.upper() != 'ETAG']
+        headers.append(('ETag',_gzip_etag(etag)))
+    headers.append(('Content-Encoding','gzip'))
+    return status,headers,body
+
+def _gzip_etag(etag):
+    if etag.endswith('"'):
+        return etag[:-1] + '-gzip"'
+    return etag + '-gzip'
 
 class StaticFileRoute(object):
-    def __init__(self):
+    """
+    Serves files under /static/ of document_root. Responses carry ETag,
+    Last-Modified and Cache-Control headers, conditional requests get 304 and
+    single byte ranges 206. Files up to max_cached_size bytes are kept in a
+    memory cache of cache_bytes invalidated by mtime, larger ones are sent
+    with wsgi.file_wrapper when the server provides it
+
+    Compressible files of at least gzip_min_size bytes are sent gzipped to
+    clients accepting it, from a .gz sibling written once and rewritten when
+    the file changes, or from the memory cache if it can not be written
+
+    """
+    def __init__(self,document_root='.',max_age=3600,cache_bytes=8 * 1024 * 1024,
+                 max_cached_size=64 * 1024,gzip_min_size=1024):
         self.method = 'GET'
         self.is_static = False
         self.route = re.compile('^/static/(.+)$')
+        self.document_root = os.path.abspath(document_root)
+        self.max_age = max_age
+        self.max_cached_size = max_cached_size
+        self.gzip_min_size = gzip_min_size
+        self._cache = db.LRUCache(max_bytes=cache_bytes)
+        self._cache_lock = threading.Lock()
 
     def match(self,url):
         if url.startswith('/static/'):
             return (url[1:],)
         return None
 
-    
+    def _resolve(self,path):
+        fpath = os.path.normpath(os.path.join(self.document_root,path))
+        if not fpath.startswith(self.document_root + os.sep):
+            raise forbidden()
+        if not os.path.isfile(fpath):
+            raise notfound()
+        return fpath
 
-    
+    def _content(self,fpath,st):
+        """
+        Return the cached content of a small file, None for large files
+
+        """
+        if st.st_size > self.max_cached_size:
+            return None
+        with self._cache_lock:
+            entry = self._cache.get(fpath)
+        if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            return entry[2]
+        with open(fpath,'rb') as f:
+            data = f.read()
+        with self._cache_lock:
+            self._cache.put(fpath,(st.st_mtime,st.st_size,data),len(data))
+        return data
+
+    def serve(self,environ,path):
+        """
+        Return (status,headers,body) for path, as returned by match
+
+        """
+        fpath = self._resolve(path)
+        st = os.stat(fpath)
+        etag = '"%x-%x"' % (int(st.st_mtime * 1000000),st.st_size)
+        headers = [('ETag',etag),
+                   ('Last-Modified',formatdate(st.st_mtime,usegmt=True)),
+                   ('Cache-Control','public, max-age=%d' % self.max_age),
+                   ('Accept-Ranges','bytes'),
+                   _HEADER_X_POWERED_BY]
+        ctype = mimetypes.guess_type(fpath)[0] or 'application/octet-stream'
+        gzipped = _RE_COMPRESSIBLE.match(ctype) and st.st_size >= self.gzip_min_size
+        if gzipped:
+            headers.append(('Vary','Accept-Encoding'))
+            if _accepts_gzip(environ) and not 'HTTP_RANGE' in environ:
+                return self._serve_gzip(environ,fpath,st,etag,ctype,headers)
+        if self._not_modified(environ,etag,st.st_mtime):
+            return _status(304),headers,[]
+        headers.append(('Content-Type',ctype))
+        r = None
+        if 'HTTP_RANGE' in environ and environ.get('HTTP_IF_RANGE',etag) == etag:
+            r = _parse_range(environ['HTTP_RANGE'],st.st_size)
+        if r is False:
+            headers.append(('Content-Range','bytes */%d' % st.st_size))
+            return _status(416),headers,[]
+        data = self._content(fpath,st)
+        if r is not None:
+            start,end = r
+            headers.append(('Content-Range','bytes %d-%d/%d' % (start,end,st.st_size)))
+            headers.append(('Content-Length',str(end - start + 1)))
+            if data is not None:
+                return _status(206),headers,[data[start:end + 1]]
+            return _status(206),headers,_static_file_generator(fpath,start,end - start + 1)
+        headers.append(('Content-Length',str(st.st_size)))
+        if data is not None:
+            return _status(200),headers,[data]
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return _status(200),headers,file_wrapper(open(fpath,'rb'),8192)
+        return _status(200),headers,_static_file_generator(fpath)
+
+    def _serve_gzip(self,environ,fpath,st,etag,ctype,headers):
+        etag = _gzip_etag(etag)
+        headers = [(k,v) for k,v in headers if k != 'ETag'] + [('ETag',etag)]
+        if self._not_modified(environ,etag,st.st_mtime):
+            return _status(304),headers,[]
+        headers.append(('Content-Type',ctype))
+        headers.append(('Content-Encoding','gzip'))
+        gz = self._gzip_sibling(fpath,st)
+        if gz is not None:
+            headers.append(('Content-Length',str(os.path.getsize(gz))))
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return _status(200),headers,file_wrapper(open(gz,'rb'),8192)
+            return _status(200),headers,_static_file_generator(gz)
+        key = fpath + '.gz'
+        with self._cache_lock:
+            entry = self._cache.get(key)
+        if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size:
+            with open(fpath,'rb') as f:
+                data = _gzip(f.read())
+            entry = (st.st_mtime,st.st_size,data)
+            with self._cache_lock:
+                self._cache.put(key,entry,len(data))
+        headers.append(('Content-Length',str(len(entry[2]))))
+        return _status(200),headers,[entry[2]]
+
+    def _gzip_sibling(self,fpath,st):
+        """
+        Return the path of an up to date .gz sibling, creating it if needed,
+        or None if it can not be written
+
+        """
+        gz = fpath + '.gz'
+        try:
+            #the sibling carries the mtime of the file it was made from
+            if int(os.path.getmtime(gz) * 1000) == int(st.st_mtime * 1000):
+                return gz
+        except OSError:
+            pass
+        tmp = '%s.%d.%d.tmp' % (gz,os.getpid(),threading.current_thread().ident)
+        try:
+            with open(fpath,'rb') as f:
+                data = _gzip(f.read())
+            with open(tmp,'wb') as f:
+                f.write(data)
+            os.utime(tmp,(st.st_mtime,st.st_mtime))
+            #rename is atomic so readers never see a partial file
+            os.rename(tmp,gz)
+            return gz
+        except (IOError,OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return None
+
+    def _not_modified(self,environ,etag,mtime):
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            return _etag_matches(environ['HTTP_IF_NONE_MATCH'],etag)
+        since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if since:
+            t = parsedate_tz(since)
+            return t is not None and int(mtime) <= mktime_tz(t)
+        return False
+
+class _RouteNode(object):
+    """
+    Node of the route trie, one level per path segment
+
+    """
+    __slots__ = ('static','params','route')
+
+    def __init__(self):
+        #literal segment -> child node
+        self.static = {}
+        #(compiled segment regex or None for a bare :var segment,child node)
+        self.params = []
+        self.route = None
+
+class Router(object):
+    """
+    Dispatch table of routes. Static routes are found with one dict lookup
+    keyed by (method,path), dynamic routes in a trie of path segments so the
+    cost of a match depends on the path length and not on the number of routes.
+    Routes matched by other means, like StaticFileRoute, are tried last
+
+    Usage:
+        router = Router()
+        router.add(Route(func))
+        route,args = router.match('GET','/blog/123')
+    """
+    def __init__(self):
+        self._static = {}
+        self._tries = {}
+        self._fallbacks = []
+
+    def add(self,route):
+        if not isinstance(route,Route):
+            self._fallbacks.append(route)
+        elif route.is_static:
+            self._static[(route.method,route.path)] = route
+        else:
+            node = self._tries.setdefault(route.method,_RouteNode())
+            for seg in route.path.split('/'):
+                node = self._child(node,seg)
+            if node.route is None:
+                node.route = route
+
+    def _child(self,node,seg):
+        if _re_route.search(seg) is None:
+            return node.static.setdefault(seg,_RouteNode())
+        pattern = _re_route.match(seg)
+        if pattern and pattern.group(0) == seg:
+            regex = None
+        else:
+            regex = re.compile(_build_regex(seg))
+        for r,child in node.params:
+            if (r and r.pattern) == (regex and regex.pattern):
+                return child
+        child = _RouteNode()
+        node.params.append((regex,child))
+        return child
+
+    def match(self,method,path):
+        """
+        Return (route,args) of the route matching path or None
+
+        """
+        route = self._static.get((method,path))
+        if route is not None:
+            return route,()
+        root = self._tries.get(method)
+        if root is not None:
+            args = []
+            route = self._match(root,path.split('/'),0,args)
+            if route is not None:
+                return route,tuple(args)
+        for route in self._fallbacks:
+            if route.method == method:
+                args = route.match(path)
+                if args is not None:
+                    return route,args
+        return None
+
+    def _match(self,node,segs,i,args):
+        if i == len(segs):
+            return node.route
+        seg = segs[i]
+        child = node.static.get(seg)
+        if child is not None:
+            route = self._match(child,segs,i + 1,args)
+            if route is not None:
+                return route
+        if not seg:
+            return None
+        for regex,child in node.params:
+            if regex is None:
+                args.append(seg)
+                n = 1
+            else:
+                m = regex.match(seg)
+                if m is None:
+                    continue
+                args.extend(m.groups())
+                n = len(m.groups())
+            route = self._match(child,segs,i + 1,args)
+            if route is not None:
+                return route
+            del args[-n:]
+        return None